@@ -8,8 +8,6 @@ import logging
 import sys
 from os import environ
 
-from aws_s3_files_autosync.common import init_config
-from aws_s3_files_autosync.local_sync import Cerberus
 from aws_s3_files_autosync.logging import LOG
 
 
@@ -21,8 +19,8 @@ class MissingConfig(ValueError):
     pass
 
 
-def main():
-    """Console script for aws_s3_files_autosync."""
+def set_parser() -> argparse.ArgumentParser:
+    """Builds the CLI arguments parser."""
     parser = argparse.ArgumentParser()
     parser.add_argument("_", nargs="*")
     options = parser.add_mutually_exclusive_group()
@@ -44,12 +42,19 @@ def main():
     parser.add_argument(
         "--debug", action="store_true", default=False, help="Enable debug logging"
     )
-    args = parser.parse_args()
-    print("Arguments: " + str(args._))
+    return parser
+
+
+def main():
+    """Console script for aws_s3_files_autosync."""
+    args = set_parser().parse_args()
 
     if args.debug and LOG.hasHandlers():
         LOG.setLevel(logging.DEBUG)
         LOG.handlers[0].setLevel(logging.DEBUG)
+    LOG.debug("Arguments: %s", args._)
+
+    from aws_s3_files_autosync.common import init_config
 
     if not (args.env_var or args.file_path) and environ.get("FILES_CONFIG", None):
         config = init_config(env_var="FILES_CONFIG")
@@ -73,6 +78,8 @@ def local_sync_main():
     Uses watchdog to drive the the changes, only based on local files changes.
     """
     config = main()
+    from aws_s3_files_autosync.local_sync import Cerberus
+
     watchdog = Cerberus(config)
     watchdog.run()
 
@@ -4,12 +4,18 @@
 from __future__ import annotations
 
 import json
+from functools import lru_cache
 from os import environ, path
 
 import yaml
 from importlib_resources import files as pkg_files
-from jsonschema import RefResolver, validate
-from yaml import Loader
+from jsonschema import RefResolver
+from jsonschema.validators import validator_for
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
 
 from aws_s3_files_autosync.logging import LOG
 
@@ -17,15 +23,23 @@ PRIORITY_TO_CLOUD = 1
 PRIORITY_TO_LOCAL = 2
 
 
-def validate_input(config):
+@lru_cache(maxsize=1)
+def _get_validator():
+    """
+    Loads the input.json schema once, checks it against its metaschema and returns the matching
+    jsonschema validator, so that subsequent validations skip reading and compiling the schema.
+    """
     source = pkg_files("aws_s3_files_autosync").joinpath("input.json")
-    LOG.debug(f"Validating input against {path.dirname(source)}")
+    LOG.debug("Loading input schema from %s", path.dirname(source))
+    schema = json.loads(source.read_text())
     resolver = RefResolver(f"file://{path.abspath(path.dirname(source))}/", None)
-    validate(
-        config,
-        json.loads(source.read_text()),
-        resolver=resolver,
-    )
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema, resolver=resolver)
+
+
+def validate_input(config):
+    _get_validator().validate(config)
 
 
 def init_config(raw=None, file_path=None, env_var=None):
@@ -49,15 +63,23 @@ def init_config(raw=None, file_path=None, env_var=None):
         config_content = environ.get(env_var, None)
     else:
         raise Exception("No input source was provided")
+    if config_content and config_content.lstrip()[:1] in ("{", "["):
+        try:
+            config = json.loads(config_content)
+            validate_input(config)
+            LOG.debug("Successfully loaded JSON config")
+            return config
+        except json.JSONDecodeError:
+            LOG.debug("Input content is not JSON formatted, trying YAML")
     try:
         config = yaml.load(config_content, Loader=Loader)
         validate_input(config)
-        LOG.debug(f"Successfully loaded YAML config")
+        LOG.debug("Successfully loaded YAML config")
         return config
     except yaml.YAMLError as error:
         config = json.loads(config_content)
         validate_input(config)
-        LOG.debug(f"Successfully loaded JSON config")
+        LOG.debug("Successfully loaded JSON config")
         return config
     except Exception:
         LOG.debug("Input content is neither JSON nor YAML formatted")
@@ -5,39 +5,36 @@
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from .s3_handler import S3ManagedFile
+    from .s3_handler import FileSnapshot, S3ManagedFile
 
 from aws_s3_files_autosync.logging import LOG
 
 
-def handle_both_files_present(file: S3ManagedFile):
+def handle_both_files_present(file: S3ManagedFile, snapshot: FileSnapshot = None):
     """
-    Function to go over the conditions when the file is present locally and in S3, of a different size and timestamp
+    Function to go over the conditions when the file is present locally and in S3, with a different content,
+    based on the timestamps.
 
     :param S3ManagedFile file: The file to evaluate.
+    :param FileSnapshot snapshot: The state of the file. Captured if not set.
     """
-    if file.s3_last_modified == file.local_last_modified:
-        LOG.debug(f"{file} - not modified since {file.local_last_modified}")
-    elif (
-        file.s3_last_modified > file.local_last_modified
-        and not file.local_and_remote_size_identical()
-    ):
-        LOG.debug(f"{file} - newer S3 version")
-        file.download()
-        LOG.debug(f"{file.object.key} - downloaded to {file.path}")
-        file._local_last_modified = file.local_last_modified
-    elif (
-        file.local_last_modified > file.s3_last_modified
-        and not file.local_and_remote_size_identical()
-    ):
-        LOG.debug(f"{file} - newer local version.")
-        file.create_s3_backup()
-        file.upload()
-        LOG.debug(f"{file.path} - uploaded to {file.object.key}")
-        file.object.load()
+    if snapshot is None:
+        snapshot = file.snapshot()
+    if snapshot.remote_mtime == snapshot.local_mtime:
+        LOG.debug("%s - not modified since %s", file, snapshot.local_mtime)
+        file.set_synced_mtime()
+    elif snapshot.remote_mtime > snapshot.local_mtime:
+        LOG.debug("%s - newer S3 version", file)
+        file.download(snapshot=snapshot)
+        LOG.debug("%s - downloaded to %s", file.s3_path, file.path)
+    elif snapshot.local_mtime > snapshot.remote_mtime:
+        LOG.debug("%s - newer local version.", file)
+        file.upload(snapshot=snapshot)
+        LOG.debug("%s - uploaded to %s", file.path, file.s3_path)
 
 
 def check_s3_changes(file: S3ManagedFile):
@@ -54,23 +51,44 @@ def check_s3_changes(file: S3ManagedFile):
 
     :param S3ManagedFile file: The file to evaluate.
     """
-    if (
-        file.exists()
-        and file.exists_in_s3()
-        and not file.local_and_remote_size_identical()
-    ):
-        handle_both_files_present(file)
-
-    elif file.exists_in_s3() and not file.exists():
-        LOG.info(f"{file} - initial download from S3")
-        file.download()
-        LOG.info(f"{file} - downloaded from S3 - {file.object.size}")
-    elif file.exists() and not file.exists_in_s3():
-        LOG.info(f"{file} - Exists locally, not in cloud. Initial upload")
-        file.upload()
-        file.object.load()
-        LOG.info(f"{file} - Uploaded. {file.object.size}")
-    elif file.local_and_remote_size_identical():
-        LOG.info(f"{file} is the same locally and in AWS S3. {file.object.size}")
+    snapshot = file.snapshot()
+    if snapshot.exists_local and snapshot.exists_remote:
+        if file.content_identical(snapshot):
+            LOG.info(
+                "%s is the same locally and in AWS S3. %s", file, snapshot.remote_size
+            )
+            file.set_synced_mtime()
+        else:
+            handle_both_files_present(file, snapshot)
+    elif snapshot.exists_remote and not snapshot.exists_local:
+        LOG.info("%s - initial download from S3", file)
+        file.download(snapshot=snapshot)
+        LOG.info("%s - downloaded from S3 - %s", file, snapshot.remote_size)
+    elif snapshot.exists_local and not snapshot.exists_remote:
+        LOG.info("%s - Exists locally, not in cloud. Initial upload", file)
+        file.upload(snapshot=snapshot)
+        LOG.info("%s - Uploaded. %s", file, snapshot.local_size)
     else:
-        LOG.info(f"File {file} does not exist locally or in S3")
+        LOG.info("File %s does not exist locally or in S3", file)
+
+
+def _safe_check_s3_changes(file: S3ManagedFile) -> None:
+    try:
+        check_s3_changes(file)
+    except Exception as error:
+        LOG.exception(error)
+        LOG.error("%s - Failed to check changes with S3", file)
+
+
+def check_files_s3_changes(files: list[S3ManagedFile], max_workers: int = None):
+    """
+    Runs check_s3_changes for multiple files concurrently, as each check is bound by the latency of
+    the S3 API calls. A failure for one file is logged and does not stop the others.
+
+    :param list[S3ManagedFile] files: The files to evaluate.
+    :param int max_workers: Maximum number of threads. Defaults to one per file, up to 32.
+    """
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers or min(32, len(files))) as executor:
+        list(executor.map(_safe_check_s3_changes, files))
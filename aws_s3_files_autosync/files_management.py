@@ -8,9 +8,15 @@ Management of files and folders in the file system
 from __future__ import annotations
 
 import re
+import sys
 import warnings
-from os import makedirs, path
-from typing import TYPE_CHECKING, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from os import cpu_count, makedirs, nice, path, sep
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Union
 
 if TYPE_CHECKING:
     from aws_s3_files_autosync.mysqldb_management import (
@@ -19,46 +25,147 @@ if TYPE_CHECKING:
     )
 
 from compose_x_common.compose_x_common import set_else_none
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileCreatedEvent, FileSystemEventHandler
 from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver, ObservedWatch
+from watchdog.observers.polling import PollingObserver
 
 from aws_s3_files_autosync.common import lean_path
 from aws_s3_files_autosync.logging import LOG
-from aws_s3_files_autosync.s3_handler import S3Config, S3ManagedFile
+from aws_s3_files_autosync.s3_handler import (
+    S3Config,
+    S3ManagedFile,
+    get_transfer_config,
+)
+
+IGNORED_PATHS_CACHE_SIZE = 10000
+REGEXES_CACHE_SIZE = 256
+DEBOUNCE_DELAY = 0.5
+MAX_BATCH_SIZE = 128
+SYNC_WORKERS = min(32, (cpu_count() or 1) * 4)
+OBSERVER_NICENESS = 19
+DEFAULT_WATCH_INTERVAL = 60
+NETWORK_FS_TYPES = frozenset(
+    {
+        "9p",
+        "afs",
+        "ceph",
+        "cifs",
+        "fuse.glusterfs",
+        "fuse.sshfs",
+        "glusterfs",
+        "lustre",
+        "nfs",
+        "nfs4",
+        "smb3",
+        "smbfs",
+    }
+)
+
+
+@lru_cache(maxsize=REGEXES_CACHE_SIZE)
+def compile_regex(regex: str) -> re.Pattern:
+    """
+    Compiles the regular expression once, for all the folders and jobs using it.
+    The cache evicts the least recently used pattern once REGEXES_CACHE_SIZE patterns are cached.
+    """
+    return re.compile(regex)
 
 
 def set_regexes_list(regexes_str: list[str]) -> list[re.Pattern]:
     regexes: list = []
     for regex in regexes_str:
         try:
-            regex_re = re.compile(regex)
+            regex_re = compile_regex(regex)
             regexes.append(regex_re)
         except Exception as error:
             LOG.exception(error)
-            LOG.error(f"{regex} - invalid regular expression")
+            LOG.error("%s - invalid regular expression", regex)
     return regexes
 
 
+def combine_regexes(regexes: list[re.Pattern]) -> Union[re.Pattern, list, None]:
+    """
+    Combines the regular expressions into a single alternation, so that matching a file name
+    takes a single call to the regex engine, regardless of the number of expressions.
+    Expressions with groups are not combined, as the alternation renumbers the groups their
+    backreferences point to. Neither are expressions with inline global flags, i.e. (?i), which
+    would apply to all of them, nor the ones that fail to compile together.
+    All return the list as-is.
+
+    :return: The combined pattern, or None if there are no expressions.
+    """
+    if not regexes:
+        return None
+    if any(regex.groups or regex.flags & ~re.UNICODE for regex in regexes):
+        return regexes
+    try:
+        return re.compile("|".join(f"(?:{regex.pattern})" for regex in regexes))
+    except re.error as error:
+        LOG.warning("Unable to combine regular expressions, matching each: %s", error)
+        return regexes
+
+
+def get_fs_type(folder_path: str) -> Union[str, None]:
+    """
+    Gets the type of the file system the folder is on, from the closest mount point in /proc/mounts.
+
+    :return: The file system type, None if it could not be determined.
+    """
+    real_path = path.realpath(folder_path)
+    fs_type, mount_point_length = None, -1
+    try:
+        with open("/proc/mounts") as mounts_fd:
+            for line in mounts_fd:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = re.sub(
+                    r"\\([0-7]{3})", lambda match: chr(int(match[1], 8)), fields[1]
+                )
+                if (
+                    real_path == mount_point
+                    or real_path.startswith(mount_point.rstrip("/") + "/")
+                ) and len(mount_point) > mount_point_length:
+                    fs_type, mount_point_length = fields[2], len(mount_point)
+    except OSError:
+        return None
+    return fs_type
+
+
 class ManagedFolder:
     """
     Manages a defined folder based on input configuration.
     Manages the watcher lifecycle and sets the IAM / S3 / else options.
     """
 
-    def __init__(self, folder_path: str, config: dict, create: bool = False):
+    def __init__(
+        self,
+        folder_path: str,
+        config: dict,
+        create: bool = False,
+        observer: BaseObserver = None,
+    ):
         self._path = folder_path
+        self.path = folder_path
+        self.abspath = path.abspath(folder_path)
+        self.dirname = path.basename(folder_path)
         self._config = config
         self.sync_priority = set_else_none("priority", config, alt_value="local")
-        self.whitelist: list = set_else_none("whitelist", config, alt_value=[])
+        self.whitelist: frozenset = frozenset(
+            set_else_none("whitelist", config, alt_value=[])
+        )
         self.whitelist_regex: list = set_else_none(
             "whitelist_regex", config, alt_value=[]
         )
         self.whitelist_re = set_regexes_list(self.whitelist_regex)
+        self.whitelist_match = combine_regexes(self.whitelist_re)
 
         self.blacklist_regex: list = set_else_none(
             "blacklist_regex", config, alt_value=[]
         )
         self.blacklist_re = set_regexes_list(self.blacklist_regex)
+        self.blacklist_match = combine_regexes(self.blacklist_re)
 
         s3_config = config["s3"]
         self.s3_config = S3Config(
@@ -67,144 +174,407 @@ class ManagedFolder:
                 set_else_none("prefix_key", s3_config, alt_value=self.dirname)
             ),
             iam_override=set_else_none("iam_override", s3_config),
+            transfer_config=get_transfer_config(
+                set_else_none("multipart_chunksize", s3_config),
+                set_else_none("max_concurrency", s3_config),
+            ),
         )
 
         if not path.exists(self.abspath):
             if not create:
                 warnings.warn(UserWarning(f"{self.abspath} does not exist."))
             else:
-                LOG.info(f"Folder {self.abspath} successfully created.")
+                LOG.info("Folder %s successfully created.", self.abspath)
                 makedirs(self.abspath, exist_ok=True)
-        self.watcher = Watcher(self.abspath, self)
-        self.files: dict = {}
+        self.backend = set_else_none("backend", config, alt_value="auto")
+        self.watch_interval = set_else_none(
+            "watch_interval", config, alt_value=DEFAULT_WATCH_INTERVAL
+        )
+        watcher_observer = self.get_observer(observer)
+        self.watcher = Watcher(
+            self.abspath,
+            self,
+            watcher_observer,
+            owns_observer=watcher_observer is None or watcher_observer is not observer,
+        )
+        self.files: dict = {
+            path.join(self.abspath, file_name): S3ManagedFile(
+                path.join(self.abspath, file_name), self
+            )
+            for file_name in self.whitelist
+            if self.file_name_is_to_watch(file_name)
+        }
+        self._ignored_paths: OrderedDict = OrderedDict()
         self.post_init_summary()
 
     def post_init_summary(self):
-        LOG.debug(self._path)
         LOG.debug(
-            f"self._path, BlackList Regex {[_re.pattern for _re in self.blacklist_re]}"
+            "%s - BlackList Regex %s",
+            self._path,
+            [_re.pattern for _re in self.blacklist_re],
         )
         LOG.debug(
-            f"self._path, Whitelist Regex {[_re.pattern for _re in self.whitelist_re]}"
+            "%s - Whitelist Regex %s",
+            self._path,
+            [_re.pattern for _re in self.whitelist_re],
         )
 
-    @property
-    def dirname(self) -> str:
-        return path.basename(self._path)
-
-    @property
-    def path(self) -> str:
-        return self._path
-
-    @property
-    def abspath(self) -> str:
-        return path.abspath(self._path)
+    def get_observer(self, observer: BaseObserver = None) -> Union[BaseObserver, None]:
+        """
+        Returns the observer to watch the folder with. The polling backend, or the auto backend on
+        network file systems, on which native notifications do not work, get their own
+        PollingObserver, scanning the folder every watch_interval seconds.
+        """
+        if self.backend == "auto":
+            fs_type = get_fs_type(self.abspath)
+            backend = "polling" if fs_type in NETWORK_FS_TYPES else "native"
+            LOG.debug("%s - File system %s, using %s", self.abspath, fs_type, backend)
+        else:
+            backend = self.backend
+        if backend == "polling":
+            return PollingObserver(timeout=self.watch_interval)
+        return observer
 
     def file_is_to_watch(self, file_name: str):
         return file_is_to_watch(
-            file_name, self.whitelist, self.whitelist_re, self.blacklist_re
+            file_name, self.whitelist, self.whitelist_match, self.blacklist_match
+        )
+
+    def file_name_is_to_watch(self, file_name: str):
+        return file_name_is_to_watch(
+            file_name, self.whitelist, self.whitelist_match, self.blacklist_match
         )
 
+    def is_ignored_path(self, file_path: str) -> bool:
+        """
+        Whether the file path was already evaluated as not to watch.
+        """
+        if file_path in self._ignored_paths:
+            self._ignored_paths.move_to_end(file_path)
+            return True
+        return False
+
+    def ignore_path(self, file_path: str) -> None:
+        """
+        Remembers a file path that does not match the folder rules, keeping the most recent
+        IGNORED_PATHS_CACHE_SIZE paths only.
+        """
+        self._ignored_paths[file_path] = None
+        if len(self._ignored_paths) > IGNORED_PATHS_CACHE_SIZE:
+            self._ignored_paths.popitem(last=False)
+
+
+class LowPriorityObserver(Observer):
+    """
+    Observer dispatching the events to the handlers at the lowest CPU priority on Linux, so that
+    bursts of events do not compete with the threads syncing the files.
+
+    :param on_exit: Called when the observer thread exits, i.e. to wake up a supervisor.
+    """
+
+    def __init__(self, *args, on_exit: Callable = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_exit = on_exit
+
+    def run(self):
+        if sys.platform.startswith("linux"):
+            try:
+                nice(OBSERVER_NICENESS)
+            except OSError as error:
+                LOG.warning("Unable to lower the observer priority: %s", error)
+        try:
+            super().run()
+        finally:
+            if self.on_exit:
+                self.on_exit()
+
 
 class Watcher:
-    def __init__(self, directory_path: str, folder: ManagedFolder):
+    """
+    Watches the folder directory. The observer can be shared with other watchers, in which case
+    one thread dispatches the events of all the folders.
+    Unless set, the watcher owns its observer only when it creates it.
+    """
+
+    def __init__(
+        self,
+        directory_path: str,
+        folder: ManagedFolder,
+        observer: BaseObserver = None,
+        owns_observer: bool = None,
+    ):
         self._directory = directory_path
-        self.observer = Observer()
+        self.directory_path = path.abspath(directory_path)
+        self.observer = observer if observer else LowPriorityObserver()
+        self.owns_observer = (
+            observer is None if owns_observer is None else owns_observer
+        )
         self.files: dict = {}
         self.folder = folder
+        self.handler: Union[Handler, None] = None
+        self.watch: Union[ObservedWatch, None] = None
+        self.pool = ThreadPoolExecutor(
+            max_workers=SYNC_WORKERS, thread_name_prefix=f"sync-{folder.dirname}"
+        )
+
+    def get_handler(self) -> Handler:
+        return Handler(self)
 
-    @property
-    def directory_path(self):
-        return path.abspath(self._directory)
+    def is_running(self) -> bool:
+        return self.watch is not None and self.observer.is_alive()
 
     def run(self):
-        event_handler = Handler(self)
-        self.observer.schedule(event_handler, self.directory_path, recursive=True)
-        self.observer.start()
+        """
+        Schedules the directory with the observer, and starts the observer if not already running.
+        On failure, the handler is removed from the observer so that retries do not stack handlers.
+        The handler, and its flusher thread, is created once and reused by the retries.
+        """
+        if self.handler is None:
+            self.handler = self.get_handler()
+        try:
+            self.watch = self.observer.schedule(
+                self.handler, self.directory_path, recursive=True
+            )
+            if not self.observer.is_alive():
+                self.observer.start()
+        except Exception:
+            self.watch = None
+            try:
+                self.observer.remove_handler_for_watch(
+                    self.handler, ObservedWatch(self.directory_path, True)
+                )
+            except KeyError:
+                pass
+            raise
+
+    def stop(self) -> None:
+        """
+        Stops watching the directory. Stops the observer if the watcher owns it, otherwise only
+        unschedules the directory so that the other folders sharing the observer are still watched.
+        """
+        if self.owns_observer:
+            self.observer.stop()
+            self.observer.join()
+        elif self.watch is not None:
+            try:
+                self.observer.unschedule(self.watch)
+            except KeyError:
+                pass
+        self.watch = None
+
+    def flush(self) -> None:
+        """
+        Syncs the files with pending events right away.
+        """
+        if self.handler:
+            self.handler.flush()
 
 
 class Handler(FileSystemEventHandler):
+    """
+    Collects the files events and processes them in batches once no new event came in for
+    DEBOUNCE_DELAY seconds, or MAX_BATCH_SIZE files are pending.
+    Only the last event of a file is kept, so a file written many times is synced only once.
+    The files of a batch are synced concurrently, with the watcher threads pool.
+    """
+
     def __init__(self, watcher: Union[Watcher, BinLogsWatcher]):
         super().__init__()
         self.watcher = watcher
-
-    @property
-    def folder(self) -> Union[ManagedFolder, ManagedMySQL]:
-        return self.watcher.folder
+        self.folder: Union[ManagedFolder, ManagedMySQL] = watcher.folder
+        self._pending: dict = {}
+        self._last_event_at: float = 0.0
+        self._condition = Condition()
+        self._flush_lock = Lock()
+        self._flusher = Thread(
+            target=self._flush_when_idle,
+            name=f"flush-{self.folder.dirname}",
+            daemon=True,
+        )
+        self._flusher.start()
 
     def on_created(self, event) -> None:
         file = get_file_from_event(event, self.folder)
         if not file:
             return
-        LOG.debug(f"{file.path} - New file added to folder monitoring")
-        try:
-            file.upload()
-        except Exception as error:
-            LOG.exception(error)
-            LOG.error(
-                f"{file.path} - Failure to upload on create. Will upload on close."
-            )
+        LOG.debug("%s - New file added to folder monitoring", file.path)
+        self.add_pending(file, "created")
 
     def on_modified(self, event) -> None:
         file = get_file_from_event(event, self.folder)
         if not file:
             return
-        LOG.debug(f"{file.path } - File closed, uploading.")
-        file.upload()
+        self.add_pending(file, "modified")
 
     def on_deleted(self, event) -> None:
         file = get_file_from_event(event, self.folder)
         if not file:
             return
-        LOG.debug(f"{file.path} - File deleted, attempting to create backup in S3.")
-        file.create_s3_backup()
+        self.add_pending(file, "deleted")
+
+    def on_moved(self, event) -> None:
+        """
+        A file renamed into the folder, such as a dump written then moved into place, is a new file.
+        """
+        if event.is_directory:
+            return
+        self.on_created(FileCreatedEvent(event.dest_path))
+
+    def add_pending(self, file: S3ManagedFile, action: str) -> None:
+        """
+        Sets the action to take for the file at the next flush, and wakes up the flusher thread.
+        A file created or closed, then modified within the same batch keeps the first action.
+        """
+        with self._condition:
+            pending = self._pending.get(file.path)
+            if not (
+                action == "modified" and pending and pending[0] in ["created", "closed"]
+            ):
+                self._pending[file.path] = (action, file)
+            self._last_event_at = monotonic()
+            self._condition.notify()
+
+    def _flush_when_idle(self) -> None:
+        """
+        Flusher thread loop. Started with the handler, outside of the observer thread, so that
+        it and the sync threads it starts run at normal priority.
+        """
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                while len(self._pending) < MAX_BATCH_SIZE:
+                    remaining = self._last_event_at + DEBOUNCE_DELAY - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            try:
+                self.flush()
+            except Exception as error:
+                LOG.exception(error)
+                LOG.error("%s - Failed to flush the pending files", self.folder.path)
+
+    def flush(self) -> None:
+        """
+        Processes all the pending files actions.
+        """
+        with self._condition:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with self._flush_lock:
+            wait(
+                [
+                    self.watcher.pool.submit(process_file_action, file, action)
+                    for action, file in pending.values()
+                ]
+            )
+            try:
+                self.after_flush(pending)
+            except Exception as error:
+                LOG.exception(error)
+                LOG.error("%s - Failed to process the synced batch", self.folder.path)
+
+    def after_flush(self, pending: dict) -> None:
+        """
+        Called once the files of a batch are synced, with the actions of the batch.
+        """
+        pass
+
+
+def process_file_action(file: S3ManagedFile, action: str) -> None:
+    """
+    Syncs the file to S3 according to the last event received for it.
+    """
+    try:
+        if action == "deleted":
+            LOG.debug(
+                "%s - File deleted, attempting to create backup in S3.", file.path
+            )
+            file.create_s3_backup()
+        else:
+            LOG.debug("%s - File %s, uploading.", file.path, action)
+            file.upload()
+    except Exception as error:
+        LOG.exception(error)
+        LOG.error("%s - Failed to sync %s file.", file.path, action)
 
 
 def get_file_from_event(
-    event, folder: Union[ManagedFolder, ManagedMySQL], override_match_regex: str = None
+    event,
+    folder: Union[ManagedFolder, ManagedMySQL],
+    override_match_regex: Union[re.Pattern, str] = None,
 ) -> Union[S3ManagedFile, None]:
     """
     Using the file name from the event, identify using white/black list and regular expressions
     to identify if the file should be ignored or used.
 
-    Defaults use the object definition, allows for override inclusion regular expression.
+    Defaults use the object definition, allows for override inclusion regular expression,
+    preferably compiled once by the caller.
     """
     if event.is_directory:
         LOG.debug("Event is for a directory.")
         return
-    _file_name = path.basename(event.src_path)
-    if event.src_path not in folder.files:
-        if not folder.file_is_to_watch(event.src_path):
-            LOG.debug(f"{event.src_path} does not match whitelisting")
-            return None
-        elif override_match_regex and not re.match(override_match_regex, _file_name):
-            LOG.debug(
-                f"{_file_name} does not match with override {override_match_regex}"
-            )
-            return None
-        else:
-            LOG.debug(f"New file to monitor {event.src_path}")
-            file_obj = S3ManagedFile(event.src_path, folder)
-            folder.files[event.src_path] = file_obj
-            return file_obj
-    else:
-        return folder.files[event.src_path]
+    file_obj = folder.files.get(event.src_path)
+    if file_obj:
+        return file_obj
+    if folder.is_ignored_path(event.src_path):
+        return None
+    _file_name = event.src_path.rpartition(sep)[2]
+    if not folder.file_name_is_to_watch(_file_name):
+        LOG.debug("%s does not match whitelisting", event.src_path)
+        folder.ignore_path(event.src_path)
+        return None
+    if isinstance(override_match_regex, str):
+        override_match_regex = compile_regex(override_match_regex)
+    if override_match_regex and not override_match_regex.match(_file_name):
+        LOG.debug(
+            "%s does not match with override %s", _file_name, override_match_regex
+        )
+        return None
+    LOG.debug("New file to monitor %s", event.src_path)
+    file_obj = S3ManagedFile(event.src_path, folder)
+    folder.files[event.src_path] = file_obj
+    return file_obj
+
+
+def regexes_match(
+    regexes: Union[re.Pattern, list[re.Pattern], None], file_name: str
+) -> bool:
+    if not regexes:
+        return False
+    if isinstance(regexes, re.Pattern):
+        return regexes.match(file_name) is not None
+    return any(pattern.match(file_name) for pattern in regexes)
 
 
 def file_is_to_watch(
     file_name: str,
-    whitelist: list[str] = None,
-    whitelist_re: list[re.Pattern] = None,
-    blacklist_re: list[re.Pattern] = None,
+    whitelist: Union[frozenset, list[str]] = None,
+    whitelist_re: Union[re.Pattern, list[re.Pattern]] = None,
+    blacklist_re: Union[re.Pattern, list[re.Pattern]] = None,
+) -> bool:
+    """
+    Determines if the file is to be watched based on the whitelist and blacklist.
+    Regular expressions can be given as a list of patterns or as a combined pattern.
+    """
+    return file_name_is_to_watch(
+        file_name.rpartition(sep)[2], whitelist, whitelist_re, blacklist_re
+    )
+
+
+def file_name_is_to_watch(
+    file_name: str,
+    whitelist: Union[frozenset, list[str]] = None,
+    whitelist_re: Union[re.Pattern, list[re.Pattern]] = None,
+    blacklist_re: Union[re.Pattern, list[re.Pattern]] = None,
 ) -> bool:
     """
-    Determines if the file is to be watched based on the whitelist and blacklist
+    Same as file_is_to_watch, for a file name already stripped from its directory.
+    The blacklist, which excludes files, is only evaluated for files the whitelist accepted.
     """
-    _file_name = path.basename(file_name)
-    if blacklist_re and any(pattern.match(_file_name) for pattern in blacklist_re):
+    if not (
+        (whitelist and file_name in whitelist) or regexes_match(whitelist_re, file_name)
+    ):
         return False
-    elif whitelist_re and any(pattern.match(_file_name) for pattern in whitelist_re):
-        return True
-    elif whitelist and _file_name in whitelist:
-        return True
-    return False
+    return not regexes_match(blacklist_re, file_name)
@@ -4,18 +4,24 @@
 """Files watcher."""
 
 import signal
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from time import sleep
+from os import path
+from threading import Event
 
 from compose_x_common.compose_x_common import keyisset
+from watchdog.observers.api import BaseObserver
 
 from aws_s3_files_autosync.common import lean_path
-from aws_s3_files_autosync.files_management import ManagedFolder
+from aws_s3_files_autosync.files_autosync import check_files_s3_changes
+from aws_s3_files_autosync.files_management import LowPriorityObserver, ManagedFolder
 from aws_s3_files_autosync.logging import LOG
 from aws_s3_files_autosync.mysqldb_management import ManagedMySQL
 
 PRIORITY_TO_CLOUD = 1
 PRIORITY_TO_LOCAL = 2
+OBSERVERS_CHECK_INTERVAL = 30
+FOLDERS_PROBE_TIMEOUT = 5
 
 
 class Cerberus:
@@ -26,20 +32,44 @@ class Cerberus:
         self.observers: list = []
         self.db_jobs: dict = {}
         self.folders_jobs: dict = {}
+        self.stopping = Event()
+        self.wake = Event()
+        self.observer = LowPriorityObserver(on_exit=self.wake.set)
+        self.probes_pool = ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix="folders-probe"
+        )
+        self.folders_probes: dict = {}
 
     def run(self):
-        self.folders_jobs = init_folders_jobs(self.config)
-        self.db_jobs = init_mysqldb_jobs(self.config)
+        self.observer.start()
+        self.observers.append(self.observer)
+        self.folders_jobs = init_folders_jobs(self.config, self.observer)
+        sync_folders_with_s3(self.folders_jobs)
+        self.db_jobs = init_mysqldb_jobs(self.config, self.observer)
         for folder_name, folder in self.folders_jobs.items():
-            folder.watcher.run()
-            self.observers.append(folder.watcher.observer)
+            try:
+                folder.watcher.run()
+                if folder.watcher.observer not in self.observers:
+                    self.observers.append(folder.watcher.observer)
+            except FileNotFoundError:
+                LOG.info("%s - Not yet available", folder.path)
         init_db_jobs(self.db_jobs, self.observers)
 
         try:
-            while True:
-                cycle_over_folders(self.folders_jobs, self.observers)
+            while not self.stopping.is_set():
+                self.wake.wait(OBSERVERS_CHECK_INTERVAL)
+                self.wake.clear()
+                if self.stopping.is_set():
+                    break
+                if not self.observer.is_alive():
+                    self.replace_observer()
+                cycle_over_folders(
+                    self.folders_jobs,
+                    self.observers,
+                    self.probes_pool,
+                    self.folders_probes,
+                )
                 cycle_over_db_jobs(self.db_jobs, self.observers)
-                sleep(1)
         except KeyboardInterrupt:
             graceful_observers_close(self.observers)
             LOG.debug("\rExited due to Keyboard interrupt")
@@ -50,34 +80,76 @@ class Cerberus:
         for observer in self.observers:
             observer.join()
 
+    def replace_observer(self) -> None:
+        """
+        Replaces the shared observer once its thread died, and schedules the folders and db jobs
+        watching with it onto the new one. Folders that cannot be watched yet are retried by the
+        next cycles.
+        """
+        LOG.error("The shared observer died. Starting a new one.")
+        dead_observer = self.observer
+        self.observer = LowPriorityObserver(on_exit=self.wake.set)
+        self.observer.start()
+        if dead_observer in self.observers:
+            self.observers.remove(dead_observer)
+        self.observers.append(self.observer)
+        watchers = [folder.watcher for folder in self.folders_jobs.values()]
+        for db_job in self.db_jobs.values():
+            watchers += [db_job.binlogs_folder.watcher, db_job.dumps_folder.watcher]
+        for watcher in watchers:
+            if watcher.observer is not dead_observer:
+                continue
+            watcher.observer = self.observer
+            watcher.watch = None
+            try:
+                watcher.run()
+            except Exception as error:
+                LOG.debug("%s - Not rescheduled: %s", watcher.directory_path, error)
+
     def exit_gracefully(self, signum, frame):
+        self.stopping.set()
+        self.wake.set()
         final_dumps_db_jobs(self.db_jobs)
         cycle_over_db_jobs(self.db_jobs, self.observers)
         cycle_over_folders(self.folders_jobs, self.observers)
         LOG.debug("Closing all observers")
         graceful_observers_close(self.observers)
-        LOG.info(f"Exiting due to caught signal {signum}")
+        flush_watchers(self.folders_jobs, self.db_jobs)
+        LOG.info("Exiting due to caught signal %s", signum)
         exit(0)
 
 
-def init_folders_jobs(config: dict):
+def init_folders_jobs(config: dict, observer: BaseObserver = None):
     folders: dict = {}
     if not keyisset("folders", config):
         return folders
     for folder_name, folder_config in config["folders"].items():
         folder = ManagedFolder(
-            folder_name, folder_config, create=keyisset("auto_create", folder_config)
+            folder_name,
+            folder_config,
+            create=keyisset("auto_create", folder_config),
+            observer=observer,
         )
         folders[folder_name] = folder
     return folders
 
 
-def init_mysqldb_jobs(config: dict) -> dict:
+def sync_folders_with_s3(folders: dict) -> None:
+    """
+    Syncs the tracked files of the existing folders with S3 once, before they get watched,
+    so that changes made while the service was not running are picked up.
+    """
+    for folder in folders.values():
+        if path.isdir(folder.abspath):
+            check_files_s3_changes(list(folder.files.values()))
+
+
+def init_mysqldb_jobs(config: dict, observer: BaseObserver = None) -> dict:
     jobs: dict = {}
     if not keyisset("mysqlDb", config):
         return jobs
     for job_name, job_config in config["mysqlDb"].items():
-        job = ManagedMySQL(job_name, job_config)
+        job = ManagedMySQL(job_name, job_config, observer)
         jobs[job_name] = job
     return jobs
 
@@ -93,71 +165,114 @@ def graceful_observers_close(observers: list) -> None:
         observer.join()
 
 
-def cycle_over_folders(folders: dict, observers: list):
-    for folder in folders.values():
-        LOG.debug(
-            f"Observer? {folder.watcher.observer} - {folder.watcher.observer.is_alive()}"
-        )
-        if not folder.watcher.observer.is_alive():
-            try:
-                folder.watcher.run()
-                if folder.watcher.observer not in observers:
-                    observers.append(folder.watcher.observer)
-            except FileNotFoundError:
-                LOG.info(f"{folder.path} - Not yet available")
-            except RuntimeError as error:
-                LOG.exception(error)
-                LOG.error(f"Stopping observer for {folder.path}")
-                folder.watcher.observer.stop()
-                folder.watcher.observer.join()
+def flush_watchers(folders: dict, db_jobs: dict) -> None:
+    """
+    Syncs the files that still have pending events, once the observers are stopped.
+    """
+    watchers = [folder.watcher for folder in folders.values()]
+    for db_job in db_jobs.values():
+        watchers += [db_job.binlogs_folder.watcher, db_job.dumps_folder.watcher]
+    for watcher in watchers:
+        try:
+            watcher.flush()
+        except Exception as error:
+            LOG.exception(error)
+
+
+def cycle_over_folders(
+    folders: dict,
+    observers: list,
+    pool: ThreadPoolExecutor = None,
+    probes: dict = None,
+):
+    """
+    Starts watching the folders which are not watched yet.
+    With a pool, the folders are probed concurrently, so that a folder on a slow or hung mount
+    does not hold the others. The cycle waits for up to FOLDERS_PROBE_TIMEOUT, and a folder still
+    being probed from a previous cycle is not probed again.
+
+    :param folders: The folders jobs
+    :param observers: The observers to close on exit
+    :param pool: Threads pool to probe the folders with
+    :param probes: The folders probes futures, kept across cycles
+    """
+    if pool is None:
+        for folder in folders.values():
+            probe_folder(folder, observers)
+        return
+    for folder_name, folder in folders.items():
+        if folder_name in probes and not probes[folder_name].done():
+            LOG.warning("%s - Still probing from previous cycle", folder.path)
+            continue
+        probes[folder_name] = pool.submit(probe_folder, folder, observers)
+    wait(probes.values(), timeout=FOLDERS_PROBE_TIMEOUT)
+
+
+def probe_folder(folder: ManagedFolder, observers: list) -> None:
+    if not folder.watcher.is_running():
+        LOG.debug("%s - Not watched. Starting watcher.", folder.path)
+        try:
+            folder.watcher.run()
+            if folder.watcher.observer not in observers:
+                observers.append(folder.watcher.observer)
+        except FileNotFoundError:
+            LOG.info("%s - Not yet available", folder.path)
+        except RuntimeError as error:
+            LOG.exception(error)
+            LOG.error("Stopping watcher for %s", folder.path)
+            folder.watcher.stop()
+            if folder.watcher.owns_observer:
                 try:
                     observers.remove(folder.watcher.observer)
                 except Exception as error:
                     LOG.exception(error)
                     LOG.error("Failed to remove observer from observers?")
-            except Exception as error:
-                LOG.error("Error with watcher for {folder.path}")
-                LOG.exception(error)
+        except Exception as error:
+            LOG.error("Error with watcher for %s", folder.path)
+            LOG.exception(error)
 
 
 def init_db_jobs(db_jobs: dict, observers: list) -> None:
     for db_job_name, db_job in db_jobs.items():
         try:
             db_job.binlogs_folder.watcher.run()
-            observers.append(db_job.binlogs_folder.watcher.observer)
+            if db_job.binlogs_folder.watcher.observer not in observers:
+                observers.append(db_job.binlogs_folder.watcher.observer)
             LOG.debug(
-                f"mysqlDb.{db_job_name} - Successfully started monitoring Binary Logs dir"
+                "mysqlDb.%s - Successfully started monitoring Binary Logs dir",
+                db_job_name,
             )
         except FileNotFoundError:
             LOG.warning(
-                f"mysqlDb.{db_job_name} - Binary Logs directory does not yet exist."
+                "mysqlDb.%s - Binary Logs directory does not yet exist.", db_job_name
             )
         try:
             db_job.dumps_folder.watcher.run()
-            observers.append(db_job.dumps_folder.watcher.observer)
+            if db_job.dumps_folder.watcher.observer not in observers:
+                observers.append(db_job.dumps_folder.watcher.observer)
             LOG.debug(
-                f"mysqlDb.{db_job_name} - Successfully started monitoring Dumps dir"
+                "mysqlDb.%s - Successfully started monitoring Dumps dir", db_job_name
             )
         except FileNotFoundError:
-            LOG.warning(f"mysqlDb.{db_job_name} - Dump directory does not yet exist.")
+            LOG.warning("mysqlDb.%s - Dump directory does not yet exist.", db_job_name)
 
 
 def cycle_over_db_jobs(db_jobs: dict, observers: list) -> None:
     for db_job_name, db_job in db_jobs.items():
-        if not db_job.binlogs_folder.watcher.observer.is_alive():
+        if not db_job.binlogs_folder.watcher.is_running():
             try:
                 db_job.binlogs_folder.watcher.run()
                 if db_job.binlogs_folder.watcher.observer not in observers:
                     observers.append(db_job.binlogs_folder.watcher.observer)
             except FileNotFoundError:
-                LOG.debug(f"mysqlDb.{db_job_name} - BinLogs not yet available")
+                LOG.debug("mysqlDb.%s - BinLogs not yet available", db_job_name)
             except Exception as error:
                 LOG.exception(error)
 
 
 def final_dumps_db_jobs(db_jobs):
     for db_job_name, db_job in db_jobs.items():
-        LOG.info(f"mysqlDb.{db_job_name} - Creating on exit DB Dump from binary logs")
+        LOG.info("mysqlDb.%s - Creating on exit DB Dump from binary logs", db_job_name)
         db_job.create_dump_from_binary_logs(
             lean_path(
                 f"{db_job.dumps_folder.path}/"
@@ -3,12 +3,22 @@
 
 from __future__ import annotations
 
+import atexit
 import logging as logthings
 import sys
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
 
+@lru_cache(maxsize=None)
 def setup_logging():
-    """ """
+    """
+    Sets up the application logger handlers. Cached, so that repeated calls return the same
+    logger instead of stacking up new handlers on it.
+    The logger only enqueues the records, written to stdout/stderr by a listener thread, so that
+    the watchdog and sync threads never wait on the output streams.
+    """
     default_format = logthings.Formatter(
         "%(asctime)s [%(levelname)8s] %(message)s",
         "%Y-%m-%d %H:%M:%S",
@@ -18,23 +28,29 @@ def setup_logging():
         "%Y-%m-%d %H:%M:%S",
     )
     root_logger = logthings.getLogger()
-    for h in root_logger.handlers:
+    for h in root_logger.handlers[:]:
         root_logger.removeHandler(h)
 
     app_logger = logthings.getLogger("s3_to_sftp")
 
-    for h in app_logger.handlers:
-        root_logger.removeHandler(h)
+    for h in app_logger.handlers[:]:
+        app_logger.removeHandler(h)
 
     stdout_handler = logthings.StreamHandler(sys.stdout)
     stdout_handler.setFormatter(default_format)
     stdout_handler.setLevel(logthings.DEBUG)
-    app_logger.addHandler(stdout_handler)
 
     stderr_handler = logthings.StreamHandler(sys.stderr)
     stderr_handler.setFormatter(debug_format)
     stderr_handler.setLevel(logthings.WARNING)
-    app_logger.addHandler(stderr_handler)
+
+    records_queue = SimpleQueue()
+    app_logger.addHandler(QueueHandler(records_queue))
+    listener = QueueListener(
+        records_queue, stdout_handler, stderr_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
     return app_logger
 
 
@@ -8,59 +8,75 @@ Management mysqlDb objects.
 from __future__ import annotations
 
 import re
-from copy import deepcopy
+import subprocess
 from datetime import datetime
-from os import path, walk
+from os import environ, path, remove, replace, scandir, sep
 from tempfile import TemporaryDirectory
+from typing import Union
 
 from compose_x_common.compose_x_common import keyisset, set_else_none
+from watchdog.observers.api import BaseObserver
 
 from aws_s3_files_autosync.common import get_prefix_key, lean_path
-from aws_s3_files_autosync.files_autosync import check_s3_changes
 from aws_s3_files_autosync.files_management import (
     Handler,
     ManagedFolder,
     Watcher,
+    compile_regex,
     get_file_from_event,
 )
 from aws_s3_files_autosync.logging import LOG
 from aws_s3_files_autosync.s3_handler import S3ManagedFile
 
+BINLOG_FILE_RE = re.compile(r"mariadb-bin.[0-9]+$")
+PARTIAL_FILE_SUFFIX = ".part"
 
-def set_regexes_list(regexes_str: list[str]) -> list[re.Pattern]:
-    regexes: list = []
-    for regex in regexes_str:
-        try:
-            regex_re = re.compile(regex)
-            regexes.append(regex_re)
-        except Exception as error:
-            LOG.exception(error)
-            LOG.error(f"{regex} is not valid")
-    return regexes
 
-
-def build_sql_command(config: dict) -> str:
+def build_sql_command(config: dict) -> list[str]:
+    """
+    Builds the mysqldump command arguments. The password is not part of them, it is passed with
+    the MYSQL_PWD environment variable so that it does not show in the processes list.
+    """
     if keyisset("hostname", config):
-        cmd = (
-            "mysqldump --protocol=TCP"
-            f" -h{config['hostname']}"
-            f" -u{config['username']}"
-            f" -p{config['password']}"
-            f" --port={config['port']}"
-            if keyisset("port", config)
-            else "--port=3306" f" {config['database']}"
-        )
+        cmd = [
+            "mysqldump",
+            "--protocol=TCP",
+            f"-h{config['hostname']}",
+            f"--port={config['port'] if keyisset('port', config) else 3306}",
+        ]
     elif keyisset("socket_path", config):
-        cmd = (
-            "mysqldump"
-            f" --socket={lean_path(config['socket_path'])}"
-            f" -u{config['username']}"
-            f" -p{config['password']}"
-            f" {config['database']}"
-        )
+        cmd = ["mysqldump", f"--socket={lean_path(config['socket_path'])}"]
     else:
         raise KeyError("Missing hostname or socket_path", config.keys())
-    return cmd
+    return cmd + [f"-u{config['username']}", config["database"]]
+
+
+def find_index_file(
+    root: str, index_file_pattern: re.Pattern, index_file_name: str = None
+) -> Union[str, None]:
+    """
+    Scans the directory, then its sub-directories, for the first binary logs index file.
+
+    :return: The path to the index file, None if not found.
+    """
+    sub_directories: list = []
+    try:
+        with scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_directories.append(entry.path)
+                elif (
+                    index_file_name and entry.name == index_file_name
+                ) or index_file_pattern.match(entry.name):
+                    return entry.path
+    except OSError as error:
+        LOG.debug("Unable to scan %s: %s", root, error)
+        return None
+    for sub_directory in sub_directories:
+        index_file = find_index_file(sub_directory, index_file_pattern, index_file_name)
+        if index_file:
+            return index_file
+    return None
 
 
 class ManagedMySQL:
@@ -78,15 +94,14 @@ class ManagedMySQL:
     If SSM Parameter name set, updates the path to S3 with the latest dump file.
     """
 
-    def __init__(
-        self,
-        name: str,
-        config: dict,
-    ):
+    def __init__(self, name: str, config: dict, observer: BaseObserver = None):
         self._job_name = name
-        self._config = deepcopy(config)
+        self._config = dict(config)
         self.config = config
         self._binlogs_path = self._config["bin_logs"]["path"]
+        self.path = self._binlogs_path
+        self.abspath = path.abspath(self._binlogs_path)
+        self.dirname = path.basename(self._binlogs_path)
         self._dumps_config = set_else_none(
             "dumps", config, alt_value={"interval": "15m"}
         )
@@ -95,32 +110,20 @@ class ManagedMySQL:
             self.create_dumps_config_from_bin_logs()
         else:
             self.set_dumps_config()
+        self.dumps_path = path.abspath(self._dumps_config["path"])
 
         self._sql_command = build_sql_command(config)
         self._bin_logs_config = config["bin_logs"]
         self.binlogs_folder = BinLogFolder(
-            self._binlogs_path, self._bin_logs_config["folder"], self
+            self._binlogs_path, self._bin_logs_config["folder"], self, observer
         )
         self.dumps_folder = ManagedFolder(
-            self.dumps_path, self._dumps_config["folder"], create=True
+            self.dumps_path,
+            self._dumps_config["folder"],
+            create=True,
+            observer=observer,
         )
 
-    @property
-    def dumps_path(self) -> str:
-        return path.abspath(self._dumps_config["path"])
-
-    @property
-    def dirname(self) -> str:
-        return path.basename(self._binlogs_path)
-
-    @property
-    def path(self) -> str:
-        return self._binlogs_path
-
-    @property
-    def abspath(self) -> str:
-        return path.abspath(self._binlogs_path)
-
     def create_dumps_config_from_bin_logs(self):
         self._temp_dir = TemporaryDirectory()
         folder_config = self.import_bin_logs_folder_config()
@@ -139,12 +142,13 @@ class ManagedMySQL:
             self._dumps_config["folder"] = folder_config
 
     def import_bin_logs_folder_config(self) -> dict:
-        folder_config = deepcopy(self._config["bin_logs"]["folder"])
-        if keyisset("whitelist", folder_config):
-            del folder_config["whitelist"]
-        if keyisset("blacklist", folder_config):
-            del folder_config["blacklist"]
+        folder_config = {
+            key: value
+            for key, value in self._config["bin_logs"]["folder"].items()
+            if key not in ["whitelist", "blacklist"]
+        }
         folder_config["whitelist_regex"]: list = [r".*.sql$"]
+        folder_config["s3"] = dict(folder_config["s3"])
         folder_config["s3"]["prefix_key"] = lean_path(
             f"{self._job_name}/dumps"
             if not keyisset("prefix_key", folder_config["s3"])
@@ -156,12 +160,18 @@ class ManagedMySQL:
         """
         Creates a MySQL dump of the database.
         """
-        cmd = self._sql_command
-        cmd += f" > {self.dumps_path}/{name}"
-        LOG.debug(f"Creating dump {name}")
-        return_code = self.run_command(cmd)
+        LOG.debug("Creating dump %s", name)
+        dump_path = path.join(self.dumps_path, name)
+        with open(f"{dump_path}{PARTIAL_FILE_SUFFIX}", "wb") as dump_fd:
+            return_code = self.run_command(
+                self._sql_command,
+                stdout=dump_fd,
+                env={**environ, "MYSQL_PWD": self.config["password"]},
+            )
         if return_code != 0:
+            remove(f"{dump_path}{PARTIAL_FILE_SUFFIX}")
             raise OSError(f"Failed to create dump {name}")
+        replace(f"{dump_path}{PARTIAL_FILE_SUFFIX}", dump_path)
 
     def create_dump_from_binary_logs(
         self,
@@ -169,80 +179,84 @@ class ManagedMySQL:
         index_file_regex: str = ".*-bin.index$",
         index_file_name: str = None,
     ):
-        index_file_pattern = re.compile(index_file_regex)
-        for root, folders, files in walk(self.abspath):
-            for _file in files:
-                if (
-                    index_file_name and _file == index_file_name
-                ) or index_file_pattern.match(_file):
-                    LOG.debug(f"Found index file {path.join(root, _file)}")
-                    index_file = path.join(root, _file)
-                    self.create_dump_from_index_file(destination_file, index_file)
-
-    def auto_store_index_files(self, files_paths: list[str]) -> None:
-        for file_path in files_paths:
-            s3_file = S3ManagedFile(file_path, self)
-            check_s3_changes(s3_file)
+        index_file = find_index_file(
+            self.abspath, compile_regex(index_file_regex), index_file_name
+        )
+        if not index_file:
+            LOG.error("No binary logs index file found in %s", self.abspath)
+            return
+        LOG.debug("Found index file %s", index_file)
+        self.create_dump_from_index_file(destination_file, index_file)
 
     def create_dump_from_index_file(self, destination_file, index_file):
         index_dir_path = path.abspath(path.dirname(index_file))
+        with scandir(index_dir_path) as entries:
+            index_dir_files = {entry.name for entry in entries}
         binary_log_files: list = []
         with open(index_file) as index_fd:
-            lines = index_fd.readlines()
-        LOG.debug(f"DB Index files: {lines}")
-        for count, line in enumerate(lines):
-            line = line.strip()
-            file_name = path.basename(line)
-            file_path = (
-                path.join(index_dir_path, file_name) if not path.exists(line) else line
+            for line in index_fd:
+                line = line.strip()
+                if not line:
+                    continue
+                LOG.debug("DB Index file: %s", line)
+                file_name = line.rpartition(sep)[2]
+                if file_name in index_dir_files:
+                    binary_log_files.append(path.join(index_dir_path, file_name))
+                elif path.exists(line):
+                    binary_log_files.append(line)
+        if not binary_log_files:
+            LOG.error("No binary logs listed in %s found", index_file)
+            return
+        LOG.debug("Creating %s to process all changes.", destination_file)
+        with open(f"{destination_file}{PARTIAL_FILE_SUFFIX}", "wb") as destination_fd:
+            return_code = self.run_command(
+                [
+                    "mysqlbinlog",
+                    "--skip-annotate-row-events",
+                    "--short-form",
+                    "-d",
+                    self.config["database"],
+                    *binary_log_files,
+                ],
+                stdout=destination_fd,
             )
-            if not path.exists(file_path):
-                continue
-            binary_log_files.append(file_path)
-        files_names = " ".join(binary_log_files)
-        tmp_dir = TemporaryDirectory()
-        dest_file_name = path.basename(destination_file)
-        temp_file_name = f"{tmp_dir.name}/{dest_file_name}"
-        cmd = (
-            f"for file in {files_names}; do"
-            " mysqlbinlog --skip-annotate-row-events --short-form $file"
-            f" -d {self.config['database']}"
-            f" >> {temp_file_name}"
-            "; done"
-        )
-        LOG.debug(f"Creating {temp_file_name} to process all changes.")
-        self.run_command(cmd)
-        LOG.debug(f"Copy {temp_file_name} to {destination_file}")
-        self.run_command(f"cp {tmp_dir.name}/{dest_file_name} {destination_file}")
-        LOG.info(f"{destination_file} creation complete.")
+        if return_code != 0:
+            remove(f"{destination_file}{PARTIAL_FILE_SUFFIX}")
+            LOG.error("Failed to create %s from the binary logs", destination_file)
+            return
+        replace(f"{destination_file}{PARTIAL_FILE_SUFFIX}", destination_file)
+        LOG.info("%s creation complete.", destination_file)
 
     @staticmethod
-    def run_command(cmd: str) -> int:
+    def run_command(cmd: list[str], stdout=None, env: dict = None) -> int:
         """
-        Runs a command in a subprocess.
-        """
-        import subprocess
+        Runs a command, without a shell. The output goes to stdout if set, logged otherwise.
 
-        process = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        process.wait()
-        stdout, stderr = process.communicate()
-        if stdout:
-            LOG.debug(stdout.decode("utf-8"))
-        if stderr:
+        :return: The command return code, 127 if the command could not be executed.
+        """
+        try:
+            process = subprocess.run(
+                cmd,
+                stdout=stdout if stdout else subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+            )
+        except OSError as error:
+            LOG.exception(error)
+            LOG.error("Unable to execute %s", cmd[0])
+            return 127
+        if process.stdout:
+            LOG.debug(process.stdout.decode("utf-8"))
+        if process.stderr:
             LOG.error("Error output from command")
-            LOG.error(stderr.decode("utf-8"))
+            LOG.error(process.stderr.decode("utf-8"))
         return process.returncode
 
-    def create_db_dump(self, file, event):
+    def create_db_dump(self, file: S3ManagedFile):
         try:
-            LOG.warning(f"{file.path} closed - Triggering mysqldump")
+            LOG.warning("%s closed - Triggering mysqldump", file.path)
             self.create_mysql_dump(
-                f"{path.basename(event.src_path)}-{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}.sql"
+                f"{file.file_name}-{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}.sql"
             )
         except OSError as error:
             LOG.exception(error)
@@ -259,10 +273,21 @@ class ManagedMySQL:
 
 
 class BinLogFolder(ManagedFolder):
-    def __init__(self, folder_path: str, config: dict, sql_manager: ManagedMySQL):
-        super().__init__(folder_path, config)
+    def __init__(
+        self,
+        folder_path: str,
+        config: dict,
+        sql_manager: ManagedMySQL,
+        observer: BaseObserver = None,
+    ):
+        super().__init__(folder_path, config, observer=observer)
         self._sql_manager = sql_manager
-        self.watcher = BinLogsWatcher(self.abspath, self)
+        self.watcher = BinLogsWatcher(
+            self.abspath,
+            self,
+            self.watcher.observer,
+            owns_observer=self.watcher.owns_observer,
+        )
 
     @property
     def sql_manager(self) -> ManagedMySQL:
@@ -270,17 +295,21 @@ class BinLogFolder(ManagedFolder):
 
 
 class BinLogsWatcher(Watcher):
-    def __init__(self, directory_path: str, folder: BinLogFolder):
-        super().__init__(directory_path, folder)
+    def __init__(
+        self,
+        directory_path: str,
+        folder: BinLogFolder,
+        observer: BaseObserver = None,
+        owns_observer: bool = None,
+    ):
+        super().__init__(directory_path, folder, observer, owns_observer)
 
     @property
     def sql_manager(self) -> ManagedMySQL:
         return self.folder.sql_manager
 
-    def run(self):
-        event_handler = BinLogHandler(self, self.sql_manager)
-        self.observer.schedule(event_handler, self.directory_path, recursive=True)
-        self.observer.start()
+    def get_handler(self) -> BinLogHandler:
+        return BinLogHandler(self, self.sql_manager)
 
 
 class BinLogHandler(Handler):
@@ -294,11 +323,18 @@ class BinLogHandler(Handler):
 
     def on_closed(self, event) -> None:
         file = get_file_from_event(
-            event, self.folder, override_match_regex=r"mariadb-bin.[0-9]+$"
+            event, self.folder, override_match_regex=BINLOG_FILE_RE
         )
         if not file:
-            LOG.warning(f"File {event.src_path} not found in the watcher files")
+            LOG.warning("File %s not found in the watcher files", event.src_path)
             return
-        LOG.debug(f"{file.path} has been closed. Updating to S3.")
-        file.upload()
-        self.folder.sql_manager.create_db_dump(file, event)
+        LOG.debug("%s has been closed. Updating to S3.", file.path)
+        self.add_pending(file, "closed")
+
+    def after_flush(self, pending: dict) -> None:
+        """
+        Once the closed binary logs of the batch are in S3, creates one DB dump for all of them.
+        """
+        closed_files = [file for action, file in pending.values() if action == "closed"]
+        if closed_files:
+            self.sql_manager.create_db_dump(closed_files[-1])
@@ -9,9 +9,11 @@ S3 files manipulation classes and functions
 
 from __future__ import annotations
 
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
 from typing import TYPE_CHECKING, Union
 
-from compose_x_common.aws import get_assume_role_session, get_session
+from compose_x_common.aws import get_assume_role_session
 from compose_x_common.compose_x_common import keyisset, set_else_none
 
 if TYPE_CHECKING:
@@ -19,35 +21,113 @@ if TYPE_CHECKING:
     from .mysqldb_management import ManagedMySQL
 
 import datetime
+import re
 from datetime import datetime as dt
-from os import path, stat
+from datetime import timezone
+from hashlib import md5
+from os import path, stat, stat_result
+from stat import S_ISREG
 
-import pytz
 from boto3 import Session
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from aws_s3_files_autosync.logging import LOG
 
+MD5_CHUNK_SIZE = 1024 * 1024
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+MD5_ETAG_RE = re.compile(r"[0-9a-fA-F]{32}")
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    io_chunksize=1024 * 1024,
+    use_threads=True,
+)
+
+S3_CLIENT_CONFIG = Config(max_pool_connections=50, tcp_keepalive=True)
+
+
+_IAM_OVERRIDE_SESSIONS: dict = {}
+_S3_RESOURCES: dict = {}
+
+
+@lru_cache(maxsize=16)
+def get_transfer_config(
+    multipart_chunksize: int = None, max_concurrency: int = None
+) -> TransferConfig:
+    """
+    Gets the transfer configuration with the given multipart settings, TRANSFER_CONFIG if none set.
+    Folders using the same settings share the same configuration.
+    """
+    if not multipart_chunksize and not max_concurrency:
+        return TRANSFER_CONFIG
+    chunksize = (
+        multipart_chunksize
+        if multipart_chunksize
+        else TRANSFER_CONFIG.multipart_chunksize
+    )
+    return TransferConfig(
+        multipart_threshold=chunksize,
+        multipart_chunksize=chunksize,
+        max_concurrency=(
+            max_concurrency if max_concurrency else TRANSFER_CONFIG.max_concurrency
+        ),
+        io_chunksize=TRANSFER_CONFIG.io_chunksize,
+        use_threads=True,
+    )
+
+
+@lru_cache(maxsize=1)
+def get_default_session() -> Session:
+    """
+    Session used when none is given, shared so that all the folders resolve credentials once.
+    """
+    return Session()
+
+
+def get_s3_resource(session: Session):
+    """
+    Gets the S3 resource for the session, created once per session. S3 configurations using the
+    same session share the same client, and the same HTTP connections pool.
+    """
+    if session not in _S3_RESOURCES:
+        _S3_RESOURCES[session] = session.resource("s3", config=S3_CLIENT_CONFIG)
+    return _S3_RESOURCES[session]
+
 
 def get_iam_override_session(
     iam_override: dict, src_session: Session = None
 ) -> Session:
     """
+    Gets the session to use for the IAM override. Sessions are cached per source session
+    and role settings, so that folders sharing the same role only call sts:AssumeRole once.
 
-    :param iam_override:
-    :param src_session:
-    :return:
+    :param iam_override: The IAM override definition
+    :param src_session: The session used to assume the role with
+    :return: The session for the IAM role
     """
-    src_session = get_session(src_session)
     kwargs: dict = {}
     if keyisset("external_id", iam_override):
-        kwargs["external_id"]: str = iam_override["external_id"]
+        kwargs["ExternalId"]: str = iam_override["external_id"]
     session_name = set_else_none("session_name", iam_override)
-    iam_role = set_else_none("iam_role", iam_override)
-    dst_session: Session = get_assume_role_session(
-        src_session, iam_role, session_name, **kwargs
+    if session_name:
+        kwargs["RoleSessionName"]: str = session_name
+    iam_role = set_else_none(
+        "role_arn", iam_override, alt_value=set_else_none("iam_role", iam_override)
     )
-    return dst_session
+    cache_key = (src_session, iam_role, tuple(sorted(kwargs.items())))
+    if cache_key not in _IAM_OVERRIDE_SESSIONS:
+        _IAM_OVERRIDE_SESSIONS[cache_key] = get_assume_role_session(
+            src_session if src_session else get_default_session(),
+            iam_role,
+            session_name,
+            **kwargs,
+        )
+    return _IAM_OVERRIDE_SESSIONS[cache_key]
 
 
 class S3Config:
@@ -61,21 +141,45 @@ class S3Config:
         prefix_key: str,
         iam_override: dict = None,
         session: Session = None,
+        transfer_config: TransferConfig = None,
     ):
         self.bucket_name = bucket_name
-        self.prefix_key = (
-            prefix_key if not prefix_key.startswith(r"/") else prefix_key[1:]
-        )
+        self.transfer_config = transfer_config if transfer_config else TRANSFER_CONFIG
+        self.prefix_key = prefix_key.strip("/")
+        self.key_prefix = f"{self.prefix_key}/" if self.prefix_key else ""
         if iam_override:
             self.session = get_iam_override_session(iam_override, src_session=session)
         else:
-            self.session = get_session(session)
+            self.session = session if session else get_default_session()
+        self.resource = get_s3_resource(self.session)
+        self.client = self.resource.meta.client
+        self.bucket = self.resource.Bucket(self.bucket_name)
 
     def s3_object(self, file_name: str):
+        return self.bucket.Object(self.key_prefix + file_name)
+
+
+@dataclass
+class FileSnapshot:
+    """
+    Point in time state of a file, locally and in S3, captured with one stat and one HEAD call.
+    """
+
+    exists_local: bool
+    local_mtime: Union[datetime.datetime, None]
+    local_size: Union[int, None]
+    exists_remote: bool
+    remote_mtime: Union[datetime.datetime, None]
+    remote_size: Union[int, None]
+    etag: Union[str, None]
+    etag_is_md5: bool = True
+
+    @property
+    def sizes_identical(self) -> bool:
         return (
-            self.session.resource("s3")
-            .Bucket(self.bucket_name)
-            .Object(f"{self.prefix_key}/{file_name}")
+            self.exists_local
+            and self.exists_remote
+            and self.local_size == self.remote_size
         )
 
 
@@ -88,65 +192,73 @@ class S3ManagedFile:
         self.folder = folder
         self._file_path = file_path
         self.path = path.abspath(file_path)
-        self.resource = self.session.resource("s3")
-        self.object = self.resource.ObjectSummary(self.bucket_name, self.s3_path)
+        self.file_name = path.basename(self.path)
+        self.bucket_name = folder.s3_config.bucket_name
+        self.s3_path = folder.s3_config.key_prefix + path.relpath(
+            self.path, folder.abspath
+        )
+        self.s3_repr = f"{self.bucket_name}/{self.s3_path}"
+        self.resource = self.folder.s3_config.resource
+        self.client = self.folder.s3_config.client
+        self._md5_cache: tuple = None
+        self._synced_stat: Union[tuple, None] = None
+        self._synced_etag: Union[str, None] = None
+
+    @cached_property
+    def object(self):
+        """
+        The S3 ObjectSummary of the file. Created on first use, so that tracking a new file from
+        the watchdog thread only sets attributes.
+        """
+        return self.resource.ObjectSummary(self.bucket_name, self.s3_path)
 
     @property
     def session(self) -> Session:
         return self.folder.s3_config.session
 
-    @property
-    def file_name(self) -> str:
-        return path.basename(self.path)
-
     @property
     def priority(self) -> str:
         return self.folder.sync_priority
 
-    @property
-    def bucket_name(self) -> str:
-        return self.folder.s3_config.bucket_name
-
-    @property
-    def s3_path(self) -> str:
-        if self.folder.s3_config.prefix_key.endswith("/"):
-            prefix_key = self.folder.s3_config.prefix_key
-        else:
-            prefix_key = self.folder.s3_config.prefix_key + "/"
-        if prefix_key.startswith(r"/"):
-            prefix_key = prefix_key[1:]
-        return prefix_key + path.relpath(self.path, self.folder.abspath)
-
     def __repr__(self):
         return self.path
 
-    @property
-    def s3_repr(self) -> str:
-        return f"{self.bucket_name}/{self.s3_path}"
-
     @property
     def local_last_modified(self) -> Union[datetime.datetime, None]:
         """
         Last modified datetime for local file
         :return:
         """
-        if self.exists():
-            return pytz.UTC.localize(dt.fromtimestamp(path.getmtime(self.path)))
+        file_stat = self._stat()
+        if file_stat and S_ISREG(file_stat.st_mode):
+            return dt.fromtimestamp(file_stat.st_mtime, tz=timezone.utc)
         return None
 
-    @property
-    def _local_last_modified(self) -> datetime.datetime:
-        return self._local_last_modified
+    def local_has_changed(self, file_stat: stat_result = None) -> bool:
+        """
+        Checks if the local file size or last modified changed since the file was last synced
+        with S3.
 
-    @_local_last_modified.setter
-    def _local_last_modified(self, modified):
-        self._local_last_modified = modified
+        :param file_stat: The file stat, if the caller already has it.
+        """
+        if file_stat is None:
+            file_stat = self._stat()
+        if self._synced_stat is None or file_stat is None:
+            return True
+        return (file_stat.st_size, file_stat.st_mtime_ns) != self._synced_stat
 
-    def local_has_changed(self) -> bool:
+    def set_synced_mtime(self, file_stat: stat_result = None) -> None:
         """
-        Checks if the local last modified changed.
+        Records the local size and last modified time, in nanoseconds, of the file just synced
+        with S3.
+
+        :param file_stat: The file stat taken before the sync, if the caller has it.
         """
-        return self._local_last_modified < self.local_last_modified
+        if file_stat is None:
+            file_stat = self._stat()
+        self._synced_stat = (
+            (file_stat.st_size, file_stat.st_mtime_ns) if file_stat else None
+        )
 
     @property
     def s3_last_modified(self) -> datetime.datetime:
@@ -154,12 +266,9 @@ class S3ManagedFile:
         Gets the last modified time for object
         :return:
         """
-        if self.exists_in_s3():
-            self.object.load()
-            try:
-                return pytz.UTC.localize(self.object.last_modified)
-            except ValueError:
-                return self.object.last_modified
+        head = self.head()
+        if head:
+            return head["LastModified"]
         return None
 
     def local_and_remote_size_identical(self) -> bool:
@@ -169,35 +278,120 @@ class S3ManagedFile:
         :return: remote size == local size ?
         :rtype: bool
         """
-        if not self.exists():
+        file_stat = self._stat()
+        if not file_stat or not S_ISREG(file_stat.st_mode):
             return False
-        local_size = path.getsize(self.path)
-        remote_size = self.object.size
-        return local_size == remote_size
+        head = self.head()
+        return head is not None and file_stat.st_size == head["ContentLength"]
+
+    def _stat(self) -> Union[stat_result, None]:
+        """
+        Single stat call on the local file, shared by the local state accessors.
+
+        :return: The file stat, None if the file does not exist.
+        """
+        try:
+            return stat(self.path)
+        except FileNotFoundError:
+            return None
 
     def exists(self) -> bool:
         """
         Whether the file exists or not in filesystem
         """
-        return path.isfile(self.path)
+        file_stat = self._stat()
+        return file_stat is not None and S_ISREG(file_stat.st_mode)
 
-    def updated_in_s3(self, timestamp=None) -> bool:
+    def snapshot(self) -> FileSnapshot:
         """
-        Checks whether the file exists in AWS S3 Bucket or not.
+        Captures the local and S3 state of the file at once, to avoid repeated stat / HEAD calls
+        when evaluating what needs to happen to the file.
+        """
+        file_stat = self._stat()
+        exists_local = file_stat is not None and S_ISREG(file_stat.st_mode)
+        head = self.head()
+        return FileSnapshot(
+            exists_local=exists_local,
+            local_mtime=dt.fromtimestamp(file_stat.st_mtime, tz=timezone.utc)
+            if exists_local
+            else None,
+            local_size=file_stat.st_size if exists_local else None,
+            exists_remote=head is not None,
+            remote_mtime=head["LastModified"] if head else None,
+            remote_size=head["ContentLength"] if head else None,
+            etag=head["ETag"] if head else None,
+            etag_is_md5=bool(head)
+            and head.get("ServerSideEncryption") != "aws:kms"
+            and not head.get("SSECustomerAlgorithm"),
+        )
 
+    def local_md5(self) -> Union[str, None]:
+        """
+        MD5 hex digest of the local file, read by chunks of MD5_CHUNK_SIZE.
+        Cached against the file mtime and size, so it is only computed again when the file changed.
+        """
+        file_stat = self._stat()
+        if not file_stat:
+            return None
+        cache_key = (file_stat.st_mtime_ns, file_stat.st_size)
+        if self._md5_cache and self._md5_cache[0] == cache_key:
+            return self._md5_cache[1]
+        digest = md5()
+        with open(self.path, "rb") as data:
+            for chunk in iter(lambda: data.read(MD5_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        self._md5_cache = (cache_key, digest.hexdigest())
+        return self._md5_cache[1]
+
+    def content_identical(self, snapshot: FileSnapshot = None) -> bool:
+        """
+        Checks whether the local file and the S3 object have the same content, comparing the
+        object ETag to the local file MD5. The ETag of multipart uploads and of SSE-KMS or SSE-C
+        encrypted objects is not an MD5 of the content, in which case this only compares sizes.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        if not snapshot.sizes_identical:
+            return False
+        etag = snapshot.etag.strip('"')
+        if not snapshot.etag_is_md5 or not MD5_ETAG_RE.fullmatch(etag):
+            return True
+        return self.local_md5() == etag
+
+    def head(self, **kwargs) -> Union[dict, None]:
+        """
+        Retrieves the object metadata from S3 with a HeadObject call.
+
+        :param kwargs: Extra arguments for HeadObject, i.e. IfModifiedSince
+        :return: The HeadObject response, None if the object does not exist.
         :raises: botocore.exceptions.ClientError if the ClientError code is not 404
         """
+        try:
+            return self.client.head_object(
+                Bucket=self.bucket_name, Key=self.s3_path, **kwargs
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+                return None
+            raise
+
+    def updated_in_s3(self, timestamp=None) -> bool:
+        """
+        Checks whether the file in AWS S3 Bucket was modified since timestamp.
+
+        :raises: botocore.exceptions.ClientError if the ClientError code is not 304 or 404
+        """
         if timestamp is None:
             timestamp = dt.now()
-        if self.exists_in_s3():
-            try:
-                self.object.get(IfModifiedSince=timestamp)
-                return True
-            except ClientError as error:
-                if error.response["Error"]["Code"] == "304":
-                    LOG.debug(f"In S3 was not modified since {timestamp}.")
-                    return False
-        return False
+        try:
+            return self.head(IfModifiedSince=timestamp) is not None
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ["304", "PreconditionFailed"]:
+                LOG.debug(
+                    "%s - In S3 was not modified since %s.", self.s3_repr, timestamp
+                )
+                return False
+            raise
 
     def exists_in_s3(self) -> bool:
         """
@@ -206,69 +400,148 @@ class S3ManagedFile:
         :rtype: bool
         :raises: botocore.exceptions.ClientError if the ClientError code is not 404
         """
-        try:
-            if self.object.e_tag:
-                return True
-            return False
-        except self.resource.meta.client.exceptions.NoSuchKey:
-            return False
-        except ClientError as error:
-            if error.response["Error"]["Code"] == "404":
-                return False
-            raise
+        return self.head() is not None
 
-    def upload(self, override_key: str = None) -> None:
+    def upload(self, override_key: str = None, snapshot: FileSnapshot = None) -> None:
         """
-        Simple method to upload the file data content to AWS S3
+        Simple method to upload the file data content to AWS S3.
+        Files larger than the multipart threshold are uploaded in parts, in parallel.
+        Skipped without any S3 call if the file did not change since it was last synced. A file
+        not synced yet is not uploaded if the S3 object has the same size and is more recent.
+
+        :param override_key: Upload to this key instead of the file S3 path.
+        :param snapshot: The state of the file if the caller just captured it, saves a HeadObject call.
         """
+        file_stat = self._stat()
+        if not override_key and not self.local_has_changed(file_stat):
+            LOG.debug("%s - Not modified since last sync. Skipping upload", self.path)
+            return
+        if file_stat is None:
+            LOG.error("%s - File no longer exists. Skipping upload", self.path)
+            return
         try:
-            if stat(self.path).st_size == 0:
-                LOG.debug(f"File {self.path} is empty. Skipping upload")
+            if file_stat.st_size == 0:
+                LOG.debug("File %s is empty. Skipping upload", self.path)
                 return
-            if self.exists_in_s3():
+            if snapshot is None:
+                head = self.head()
+                remote_mtime = head["LastModified"] if head else None
+                remote_size = head["ContentLength"] if head else None
+            else:
+                remote_mtime = snapshot.remote_mtime if snapshot.exists_remote else None
+                remote_size = snapshot.remote_size
+            if (
+                not override_key
+                and self._synced_stat is None
+                and remote_mtime
+                and remote_size == file_stat.st_size
+                and dt.fromtimestamp(file_stat.st_mtime, tz=timezone.utc)
+                <= remote_mtime
+            ):
+                LOG.debug("%s - Same size and older than in S3. Skipping", self.path)
+                self.set_synced_mtime(file_stat)
+                return
+            if remote_mtime:
                 LOG.debug(
-                    f"{self.s3_repr} - "
-                    "Creating backup file in S3 before pushing new one with same name"
+                    "%s - Creating backup file in S3 before pushing new one with same name",
+                    self.s3_repr,
                 )
-                self.create_s3_backup()
-            with open(self.path, "rb") as data:
-                if not override_key:
-                    self.object.Object().upload_fileobj(data)
-                else:
-                    override_object = self.resource.Object(
-                        self.bucket_name, override_key
-                    )
-                    override_object.upload_fileobj(data)
-        except ClientError as error:
+                self.create_s3_backup(last_modified=remote_mtime, size=remote_size)
+            self.client.upload_file(
+                self.path,
+                self.bucket_name,
+                override_key if override_key else self.s3_path,
+                Config=self.folder.s3_config.transfer_config,
+            )
+            if not override_key:
+                self.set_synced_mtime(file_stat)
+        except (ClientError, S3UploadFailedError) as error:
             LOG.exception(error)
-            LOG.error(f"Failed to upload {self.path} to S3")
+            LOG.error("Failed to upload %s to S3", self.path)
         except OSError as error:
             LOG.exception(error)
             LOG.error("Failed to upload file to S3")
 
-    def download(self, override_path: str = None) -> None:
+    def download(
+        self, override_path: str = None, snapshot: FileSnapshot = None
+    ) -> None:
         """
-        Simple method to download the file from S3
+        Simple method to download the file from S3.
+        With the snapshot, skipped if the object ETag is the one last downloaded and the local file
+        did not change since.
+
+        :param override_path: Download to this path instead of the file path.
+        :param snapshot: The state of the file if the caller just captured it.
         """
-        with open(self.path if not override_path else override_path, "wb") as data:
-            self.object.Object().download_fileobj(data)
+        if (
+            snapshot
+            and not override_path
+            and snapshot.etag
+            and snapshot.etag == self._synced_etag
+            and not self.local_has_changed()
+        ):
+            LOG.debug("%s - Already downloaded. Skipping", self.s3_repr)
+            return
+        self.client.download_file(
+            self.bucket_name,
+            self.s3_path,
+            self.path if not override_path else override_path,
+            Config=self.folder.s3_config.transfer_config,
+        )
+        if not override_path:
+            self.set_synced_mtime()
+            self._synced_etag = snapshot.etag if snapshot else None
 
-    def create_s3_backup(self, exit_on_failure: bool = False) -> None:
+    def create_s3_backup(
+        self,
+        exit_on_failure: bool = False,
+        last_modified: datetime.datetime = None,
+        size: int = None,
+    ) -> None:
         """
         Creates a copy of the current object into S3 with the last modified timestamp of the original file.
         Gets the file extension (if any) and appends it back to the extension back for ease.
+        The copy is done server-side, with a single CopyObject call up to MAX_COPY_OBJECT_SIZE,
+        with a multipart copy for larger objects.
+
+        :param exit_on_failure: Raise FileNotFoundError if the object is not in S3.
+        :param last_modified: The object last modified time, if the caller already retrieved it.
+        :param size: The object size, if the caller already retrieved it.
         """
-        if not self.exists_in_s3():
-            LOG.error(f"{self.s3_repr} - File not present in S3 for copy to backup")
+        if last_modified is None:
+            head = self.head()
+            last_modified = head["LastModified"] if head else None
+            size = head["ContentLength"] if head else None
+        if not last_modified:
+            LOG.error("%s - File not present in S3 for copy to backup", self.s3_repr)
             if exit_on_failure:
                 raise FileNotFoundError(
                     "Source file in S3 not found for copy into backup."
                 )
             return
-        backup_suffix = self.object.last_modified.timestamp()
-        file_backup = self.resource.Object(
-            self.bucket_name,
-            f"{self.object.key}-{backup_suffix}{path.splitext(self.path)[-1]}",
+        backup_key = (
+            f"{self.s3_path}-{last_modified.timestamp()}{path.splitext(self.path)[-1]}"
         )
-        file_backup.copy({"Bucket": file_backup.bucket_name, "Key": self.object.key})
-        LOG.debug(f"Backup created for {self.s3_repr}")
+        copy_source = {"Bucket": self.bucket_name, "Key": self.s3_path}
+        try:
+            if size and size > MAX_COPY_OBJECT_SIZE:
+                self.client.copy(
+                    copy_source,
+                    self.bucket_name,
+                    backup_key,
+                    Config=self.folder.s3_config.transfer_config,
+                )
+            else:
+                self.client.copy_object(
+                    Bucket=self.bucket_name, Key=backup_key, CopySource=copy_source
+                )
+        except ClientError as error:
+            if error.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+                raise
+            LOG.error("%s - File removed from S3 before copy to backup", self.s3_repr)
+            if exit_on_failure:
+                raise FileNotFoundError(
+                    "Source file in S3 not found for copy into backup."
+                )
+            return
+        LOG.debug("Backup created for %s", self.s3_repr)
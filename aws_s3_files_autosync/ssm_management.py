@@ -8,26 +8,43 @@ Management of the SSM parameter that stores the path to a file in S3.
 from __future__ import annotations
 
 import json
-from copy import deepcopy
+from time import monotonic
 from typing import Union
 
 from boto3.session import Session
 from compose_x_common.aws import get_session
 
+SSM_CACHE_TTL = 30
+
 
 class SsmParameter:
-    def __init__(self, config: dict, session: Session = None):
-        self._config = deepcopy(config)
+    def __init__(
+        self, config: dict, session: Session = None, ttl: float = SSM_CACHE_TTL
+    ):
+        self._config = dict(config)
         self.name = config["name"]
         self.session = get_session(session)
+        self.client = self.session.client("ssm")
+        self.ttl = ttl
+        self._cache: tuple = None
 
     @property
     def current(self) -> dict:
-        return self.session.client("ssm").get_parameter(ParameterName=self.name)
+        """
+        The GetParameter response, cached for ttl seconds.
+        """
+        if self._cache and monotonic() - self._cache[0] < self.ttl:
+            return self._cache[1]
+        response = self.client.get_parameter(Name=self.name)
+        self._cache = (monotonic(), response)
+        return response
+
+    def invalidate(self) -> None:
+        self._cache = None
 
     @property
     def current_value(self) -> str:
-        return self.current["Value"]
+        return self.current["Parameter"]["Value"]
 
     @current_value.setter
     def current_value(self, value: Union[str, dict, list]):
@@ -35,12 +52,15 @@ class SsmParameter:
             raise TypeError(
                 f"Unsupported type {type(value)}. Expected one of", (str, list, dict)
             )
-        client = self.session.client("ssm")
         if isinstance(value, str):
-            client.put_parameter(
+            self.client.put_parameter(
                 Name=self.name, Value=value, Type="String", Overwrite=True
             )
         elif isinstance(value, (dict, list)):
-            client.put_parameter(
-                Name=self.name, Value=json.dumps(value), Type="String", Overwrite=True
+            self.client.put_parameter(
+                Name=self.name,
+                Value=json.dumps(value, separators=(",", ":")),
+                Type="String",
+                Overwrite=True,
             )
+        self.invalidate()
@@ -0,0 +1,178 @@
+"""
+Tests for the files matching rules of managed folders
+"""
+
+from threading import Event
+from threading import enumerate as threads
+
+import pytest
+from watchdog.events import (
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+)
+from watchdog.observers.polling import PollingObserver
+
+from aws_s3_files_autosync.files_management import (
+    Handler,
+    LowPriorityObserver,
+    ManagedFolder,
+    combine_regexes,
+    regexes_match,
+    set_regexes_list,
+)
+
+
+@pytest.fixture()
+def folder(tmp_path):
+    return ManagedFolder(
+        str(tmp_path),
+        {
+            "whitelist": ["the_rainbow"],
+            "whitelist_regex": [r".*\.log$", r"^mariadb-bin\.[0-9]+$"],
+            "blacklist_regex": [r"^debug.*"],
+            "s3": {"bucket_name": "sacrificial-lamb", "prefix_key": "over"},
+        },
+    )
+
+
+def test_file_is_to_watch(folder, tmp_path):
+    assert folder.file_is_to_watch(f"{tmp_path}/the_rainbow")
+    assert folder.file_is_to_watch(f"{tmp_path}/app.log")
+    assert folder.file_is_to_watch(f"{tmp_path}/mariadb-bin.000001")
+    assert not folder.file_is_to_watch(f"{tmp_path}/debug.log")
+    assert not folder.file_is_to_watch(f"{tmp_path}/somewhere")
+
+
+def test_combine_regexes():
+    assert combine_regexes([]) is None
+    combined = combine_regexes(set_regexes_list([r"^a$", r"^b$"]))
+    assert combined.match("a") and combined.match("b")
+    assert not combined.match("ab")
+    duplicate_groups = set_regexes_list([r"(?P<name>a)", r"(?P<name>b)"])
+    assert combine_regexes(duplicate_groups) == duplicate_groups
+    backreferences = set_regexes_list([r"(a)\1\.log", r"(b)\1\.log"])
+    assert combine_regexes(backreferences) == backreferences
+    assert regexes_match(combine_regexes(backreferences), "bb.log")
+    inline_flags = set_regexes_list([r"^debug", r"(?i).*\.LOG$"])
+    assert combine_regexes(inline_flags) == inline_flags
+    assert not regexes_match(combine_regexes(inline_flags), "DEBUG")
+    assert regexes_match(combine_regexes(inline_flags), "app.log")
+
+
+def test_ignored_paths_are_bounded(folder, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        "aws_s3_files_autosync.files_management.IGNORED_PATHS_CACHE_SIZE", 2
+    )
+    for name in ["a", "b", "c"]:
+        folder.ignore_path(f"{tmp_path}/{name}")
+    assert not folder.is_ignored_path(f"{tmp_path}/a")
+    assert folder.is_ignored_path(f"{tmp_path}/b")
+    assert folder.is_ignored_path(f"{tmp_path}/c")
+
+
+def test_handler_batches_events(folder, tmp_path, monkeypatch):
+    monkeypatch.setattr("aws_s3_files_autosync.files_management.DEBOUNCE_DELAY", 60)
+    calls: list = []
+    monkeypatch.setattr(
+        "aws_s3_files_autosync.files_management.process_file_action",
+        lambda file, action: calls.append((file.file_name, action)),
+    )
+    handler = Handler(folder.watcher)
+    handler.on_created(FileCreatedEvent(f"{tmp_path}/app.log"))
+    handler.on_modified(FileModifiedEvent(f"{tmp_path}/app.log"))
+    handler.on_modified(FileModifiedEvent(f"{tmp_path}/the_rainbow"))
+    handler.on_deleted(FileDeletedEvent(f"{tmp_path}/the_rainbow"))
+    handler.on_modified(FileModifiedEvent(f"{tmp_path}/somewhere"))
+    handler.flush()
+    assert sorted(calls) == [("app.log", "created"), ("the_rainbow", "deleted")]
+    assert not handler._pending
+
+
+def test_handler_tracks_files_moved_in(folder, tmp_path, monkeypatch):
+    monkeypatch.setattr("aws_s3_files_autosync.files_management.DEBOUNCE_DELAY", 60)
+    handler = Handler(folder.watcher)
+    handler.on_moved(FileMovedEvent(f"{tmp_path}/app.log.part", f"{tmp_path}/app.log"))
+    assert handler._pending[f"{tmp_path}/app.log"][0] == "created"
+    handler._pending.clear()
+
+
+def test_whitelisted_files_are_tracked(folder, tmp_path):
+    assert list(folder.files) == [f"{tmp_path}/the_rainbow"]
+
+
+def test_polling_backend(tmp_path):
+    folder = ManagedFolder(
+        str(tmp_path),
+        {
+            "whitelist": ["the_rainbow"],
+            "backend": "polling",
+            "watch_interval": 30,
+            "s3": {"bucket_name": "sacrificial-lamb"},
+        },
+    )
+    assert isinstance(folder.watcher.observer, PollingObserver)
+    assert folder.watcher.observer.timeout == 30
+    assert folder.watcher.owns_observer
+
+
+def test_watcher_retries_reuse_the_handler(tmp_path):
+    with pytest.warns(UserWarning):
+        folder = ManagedFolder(
+            str(tmp_path / "nowhere"),
+            {"whitelist": ["the_rainbow"], "s3": {"bucket_name": "sacrificial-lamb"}},
+        )
+    for _ in range(3):
+        with pytest.raises(OSError):
+            folder.watcher.run()
+    flushers = [thread for thread in threads() if thread.name == "flush-nowhere"]
+    assert len(flushers) == 1
+
+
+def test_stopping_a_watcher_keeps_the_shared_observer(tmp_path):
+    observer = LowPriorityObserver()
+    folders = [
+        ManagedFolder(
+            str(tmp_path / name),
+            {"whitelist": ["the_rainbow"], "s3": {"bucket_name": "sacrificial-lamb"}},
+            create=True,
+            observer=observer,
+        )
+        for name in ["over", "somewhere"]
+    ]
+    try:
+        for folder in folders:
+            folder.watcher.run()
+        assert not folders[0].watcher.owns_observer
+        folders[0].watcher.stop()
+        assert observer.is_alive()
+        assert len(observer.emitters) == 1
+        assert not folders[0].watcher.is_running()
+        assert folders[1].watcher.is_running()
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def test_flusher_survives_after_flush_errors(folder, tmp_path, monkeypatch):
+    monkeypatch.setattr("aws_s3_files_autosync.files_management.DEBOUNCE_DELAY", 0.01)
+    calls: list = []
+    monkeypatch.setattr(
+        "aws_s3_files_autosync.files_management.process_file_action",
+        lambda file, action: calls.append((file.file_name, action)),
+    )
+    flushed = Event()
+
+    class FailingHandler(Handler):
+        def after_flush(self, pending: dict) -> None:
+            flushed.set()
+            raise OSError("the rainbow is gone")
+
+    handler = FailingHandler(folder.watcher)
+    handler.on_created(FileCreatedEvent(f"{tmp_path}/app.log"))
+    assert flushed.wait(5)
+    flushed.clear()
+    handler.on_created(FileCreatedEvent(f"{tmp_path}/other.log"))
+    assert flushed.wait(5)
+    assert sorted(calls) == [("app.log", "created"), ("other.log", "created")]
@@ -0,0 +1,68 @@
+"""
+Tests for the folders and jobs supervision
+"""
+
+from botocore.stub import Stubber
+
+from aws_s3_files_autosync.local_sync import (
+    Cerberus,
+    init_folders_jobs,
+    sync_folders_with_s3,
+)
+
+
+def test_sync_folders_with_s3_uploads_local_only_files(tmp_path):
+    (tmp_path / "the_rainbow").write_text("somewhere")
+    folders = init_folders_jobs(
+        {
+            "folders": {
+                str(tmp_path): {
+                    "whitelist": ["the_rainbow"],
+                    "s3": {"bucket_name": "sacrificial-lamb", "prefix_key": "over"},
+                }
+            }
+        }
+    )
+    file = folders[str(tmp_path)].files[str(tmp_path / "the_rainbow")]
+    with Stubber(file.client) as stubber:
+        stubber.add_client_error(
+            "head_object", service_error_code="404", http_status_code=404
+        )
+        stubber.add_response("put_object", {})
+        sync_folders_with_s3(folders)
+        stubber.assert_no_pending_responses()
+    assert not file.local_has_changed()
+
+
+def test_dead_shared_observer_is_replaced(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        "aws_s3_files_autosync.local_sync.signal.signal", lambda *_: None
+    )
+    cerberus = Cerberus({})
+    cerberus.observer.start()
+    cerberus.observers.append(cerberus.observer)
+    cerberus.folders_jobs = init_folders_jobs(
+        {
+            "folders": {
+                str(tmp_path): {
+                    "whitelist": ["the_rainbow"],
+                    "s3": {"bucket_name": "sacrificial-lamb"},
+                }
+            }
+        },
+        cerberus.observer,
+    )
+    watcher = cerberus.folders_jobs[str(tmp_path)].watcher
+    watcher.run()
+    dead_observer = cerberus.observer
+    dead_observer.stop()
+    dead_observer.join()
+    try:
+        cerberus.replace_observer()
+        assert cerberus.observer is not dead_observer
+        assert cerberus.observers == [cerberus.observer]
+        assert watcher.observer is cerberus.observer
+        assert watcher.is_running()
+    finally:
+        cerberus.observer.stop()
+        cerberus.observer.join()
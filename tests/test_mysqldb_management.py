@@ -0,0 +1,197 @@
+"""
+Tests for the MySQL dumps commands
+"""
+
+import re
+from os import scandir
+
+from watchdog.events import FileClosedEvent, FileModifiedEvent
+
+from aws_s3_files_autosync.files_management import ManagedFolder
+from aws_s3_files_autosync.mysqldb_management import (
+    BinLogHandler,
+    ManagedMySQL,
+    build_sql_command,
+    find_index_file,
+)
+
+
+def test_build_sql_command():
+    cmd = build_sql_command(
+        {
+            "hostname": "db.local",
+            "username": "rainbow",
+            "password": "somewhere",
+            "database": "over",
+        }
+    )
+    assert cmd == [
+        "mysqldump",
+        "--protocol=TCP",
+        "-hdb.local",
+        "--port=3306",
+        "-urainbow",
+        "over",
+    ]
+    assert "somewhere" not in " ".join(cmd)
+
+
+def test_run_command_writes_to_stdout(tmp_path):
+    output = tmp_path / "output"
+    with open(output, "wb") as output_fd:
+        assert ManagedMySQL.run_command(["echo", "the rainbow"], stdout=output_fd) == 0
+    assert output.read_text() == "the rainbow\n"
+    assert ManagedMySQL.run_command(["not-a-command-somewhere"]) == 127
+
+
+def test_find_index_file(tmp_path):
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "mariadb-bin.000001").write_text("")
+    (tmp_path / "logs" / "mariadb-bin.index").write_text("")
+    assert find_index_file(str(tmp_path), re.compile(r".*-bin.index$")) == str(
+        tmp_path / "logs" / "mariadb-bin.index"
+    )
+    assert find_index_file(str(tmp_path / "nowhere"), re.compile(r".*")) is None
+
+
+def test_dumps_folder_config_leaves_bin_logs_config_unchanged(tmp_path):
+    folder_config = {
+        "whitelist": ["mariadb-bin.index"],
+        "s3": {"bucket_name": "sacrificial-lamb", "prefix_key": "over"},
+    }
+    job = ManagedMySQL(
+        "rainbow",
+        {
+            "socket_path": "/run/mysqld/mysqld.sock",
+            "username": "rainbow",
+            "password": "somewhere",
+            "database": "over",
+            "bin_logs": {"path": str(tmp_path), "folder": folder_config},
+        },
+    )
+    dumps_config = job.import_bin_logs_folder_config()
+    assert "whitelist" not in dumps_config
+    assert dumps_config["s3"]["prefix_key"] == "over/rainbow/dumps"
+    assert folder_config == {
+        "whitelist": ["mariadb-bin.index"],
+        "s3": {"bucket_name": "sacrificial-lamb", "prefix_key": "over"},
+    }
+
+
+class FakeSQLManager:
+    def __init__(self):
+        self.dumps: list = []
+
+    def create_db_dump(self, file):
+        self.dumps.append(file.file_name)
+
+
+def test_closed_bin_logs_burst_triggers_one_dump(tmp_path, monkeypatch):
+    monkeypatch.setattr("aws_s3_files_autosync.files_management.DEBOUNCE_DELAY", 60)
+    calls: list = []
+    monkeypatch.setattr(
+        "aws_s3_files_autosync.files_management.process_file_action",
+        lambda file, action: calls.append((file.file_name, action)),
+    )
+    folder = ManagedFolder(
+        str(tmp_path),
+        {
+            "whitelist_regex": [r"^mariadb-bin\..*"],
+            "s3": {"bucket_name": "sacrificial-lamb", "prefix_key": "over"},
+        },
+    )
+    sql_manager = FakeSQLManager()
+    handler = BinLogHandler(folder.watcher, sql_manager)
+    for _ in range(3):
+        handler.on_closed(FileClosedEvent(f"{tmp_path}/mariadb-bin.000001"))
+        handler.on_modified(FileModifiedEvent(f"{tmp_path}/mariadb-bin.000001"))
+    handler.on_closed(FileClosedEvent(f"{tmp_path}/mariadb-bin.000002"))
+    handler.flush()
+    assert sorted(calls) == [
+        ("mariadb-bin.000001", "closed"),
+        ("mariadb-bin.000002", "closed"),
+    ]
+    assert len(sql_manager.dumps) == 1
+
+
+def test_mysql_dump_is_moved_in_place_once_complete(tmp_path):
+    job = ManagedMySQL(
+        "rainbow",
+        {
+            "socket_path": "/run/mysqld/mysqld.sock",
+            "username": "rainbow",
+            "password": "somewhere",
+            "database": "over",
+            "bin_logs": {
+                "path": str(tmp_path),
+                "folder": {"s3": {"bucket_name": "sacrificial-lamb"}},
+            },
+        },
+    )
+    job._sql_command = ["echo", "the rainbow"]
+    job.create_mysql_dump("over.sql")
+    assert sorted(entry.name for entry in scandir(job.dumps_path)) == ["over.sql"]
+
+
+def test_dump_from_index_file_lists_existing_bin_logs(tmp_path, monkeypatch):
+    (tmp_path / "mariadb-bin.000001").write_text("")
+    (tmp_path / "mariadb-bin.index").write_text(
+        "./mariadb-bin.000001\n./mariadb-bin.000002\n\n"
+    )
+    job = ManagedMySQL(
+        "rainbow",
+        {
+            "socket_path": "/run/mysqld/mysqld.sock",
+            "username": "rainbow",
+            "password": "somewhere",
+            "database": "over",
+            "bin_logs": {
+                "path": str(tmp_path),
+                "folder": {"s3": {"bucket_name": "sacrificial-lamb"}},
+            },
+        },
+    )
+    commands: list = []
+
+    def run_command(cmd, stdout=None):
+        commands.append(cmd)
+        return 0
+
+    monkeypatch.setattr(job, "run_command", run_command)
+    job.create_dump_from_index_file(
+        f"{job.dumps_path}/over.sql", str(tmp_path / "mariadb-bin.index")
+    )
+    assert commands == [
+        [
+            "mysqlbinlog",
+            "--skip-annotate-row-events",
+            "--short-form",
+            "-d",
+            "over",
+            str(tmp_path / "mariadb-bin.000001"),
+        ]
+    ]
+    assert sorted(entry.name for entry in scandir(job.dumps_path)) == ["over.sql"]
+
+
+def test_failed_dump_from_index_file_is_not_published(tmp_path, monkeypatch):
+    (tmp_path / "mariadb-bin.000001").write_text("")
+    (tmp_path / "mariadb-bin.index").write_text("./mariadb-bin.000001\n")
+    job = ManagedMySQL(
+        "rainbow",
+        {
+            "socket_path": "/run/mysqld/mysqld.sock",
+            "username": "rainbow",
+            "password": "somewhere",
+            "database": "over",
+            "bin_logs": {
+                "path": str(tmp_path),
+                "folder": {"s3": {"bucket_name": "sacrificial-lamb"}},
+            },
+        },
+    )
+    monkeypatch.setattr(job, "run_command", lambda cmd, stdout=None: 127)
+    job.create_dump_from_index_file(
+        f"{job.dumps_path}/over.sql", str(tmp_path / "mariadb-bin.index")
+    )
+    assert not list(scandir(job.dumps_path))
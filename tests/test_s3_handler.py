@@ -0,0 +1,216 @@
+"""
+Tests for S3 files state evaluation
+"""
+
+from datetime import datetime, timezone
+from hashlib import md5
+from os import stat, utime
+
+import pytest
+from botocore.stub import Stubber
+
+from aws_s3_files_autosync.files_autosync import check_files_s3_changes
+from aws_s3_files_autosync.files_management import ManagedFolder
+from aws_s3_files_autosync.s3_handler import (
+    TRANSFER_CONFIG,
+    FileSnapshot,
+    S3ManagedFile,
+    get_transfer_config,
+)
+
+
+@pytest.fixture()
+def folder(tmp_path):
+    return ManagedFolder(
+        str(tmp_path),
+        {
+            "whitelist": ["the_rainbow"],
+            "s3": {"bucket_name": "sacrificial-lamb", "prefix_key": "over"},
+        },
+    )
+
+
+@pytest.fixture()
+def local_file(folder, tmp_path):
+    file_path = tmp_path / "the_rainbow"
+    file_path.write_text("somewhere")
+    return S3ManagedFile(str(file_path), folder)
+
+
+def test_snapshot_local_only(local_file):
+    with Stubber(local_file.resource.meta.client) as stubber:
+        stubber.add_client_error(
+            "head_object", service_error_code="404", http_status_code=404
+        )
+        snapshot = local_file.snapshot()
+    assert snapshot.exists_local
+    assert snapshot.local_size == len("somewhere")
+    assert not snapshot.exists_remote
+    assert not snapshot.sizes_identical
+
+
+def test_snapshot_local_and_remote(local_file):
+    with Stubber(local_file.resource.meta.client) as stubber:
+        stubber.add_response(
+            "head_object",
+            {
+                "ContentLength": len("somewhere"),
+                "ETag": '"d41d8cd98f00b204e9800998ecf8427e"',
+                "LastModified": datetime(2022, 1, 1, tzinfo=timezone.utc),
+            },
+        )
+        snapshot = local_file.snapshot()
+    assert snapshot.exists_remote
+    assert snapshot.sizes_identical
+    assert snapshot.remote_mtime == datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+def test_content_identical_compares_etag_to_md5(local_file):
+    snapshot = FileSnapshot(
+        exists_local=True,
+        local_mtime=None,
+        local_size=len("somewhere"),
+        exists_remote=True,
+        remote_mtime=None,
+        remote_size=len("somewhere"),
+        etag=f'"{md5(b"somewhere").hexdigest()}"',
+    )
+    assert local_file.content_identical(snapshot)
+    snapshot.etag = f'"{md5(b"elsewhere").hexdigest()}"'
+    assert not local_file.content_identical(snapshot)
+
+
+def test_local_has_changed(local_file):
+    assert local_file.local_has_changed()
+    local_file.set_synced_mtime()
+    assert not local_file.local_has_changed()
+
+
+def test_s3_path(folder, local_file):
+    assert local_file.s3_path == "over/the_rainbow"
+    assert folder.s3_config.s3_object("the_rainbow").key == "over/the_rainbow"
+
+
+def test_object_is_created_on_first_use(local_file):
+    assert "object" not in vars(local_file)
+    assert local_file.object.key == local_file.s3_path
+    assert "object" in vars(local_file)
+
+
+def test_upload_skipped_when_not_modified(local_file):
+    local_file.set_synced_mtime()
+    with Stubber(local_file.client):
+        local_file.upload()
+
+
+def test_upload_backs_up_existing_object_with_one_head(local_file):
+    with Stubber(local_file.client) as stubber:
+        stubber.add_response(
+            "head_object",
+            {
+                "ContentLength": len("elsewhere"),
+                "LastModified": datetime(2022, 1, 1, tzinfo=timezone.utc),
+            },
+            {"Bucket": "sacrificial-lamb", "Key": "over/the_rainbow"},
+        )
+        stubber.add_response("copy_object", {})
+        stubber.add_response("put_object", {})
+        local_file.upload()
+        stubber.assert_no_pending_responses()
+    assert not local_file.local_has_changed()
+
+
+def test_get_transfer_config():
+    assert get_transfer_config() is TRANSFER_CONFIG
+    transfer_config = get_transfer_config(16 * 1024 * 1024, 4)
+    assert transfer_config.multipart_chunksize == 16 * 1024 * 1024
+    assert transfer_config.multipart_threshold == 16 * 1024 * 1024
+    assert transfer_config.max_concurrency == 4
+    assert get_transfer_config(16 * 1024 * 1024, 4) is transfer_config
+
+
+def test_upload_with_snapshot_skips_head(local_file):
+    with Stubber(local_file.client) as stubber:
+        stubber.add_client_error(
+            "head_object", service_error_code="404", http_status_code=404
+        )
+        snapshot = local_file.snapshot()
+        stubber.add_response("put_object", {})
+        local_file.upload(snapshot=snapshot)
+        stubber.assert_no_pending_responses()
+
+
+def test_upload_skipped_when_s3_is_identical_and_newer(local_file):
+    with Stubber(local_file.client) as stubber:
+        stubber.add_response(
+            "head_object",
+            {
+                "ContentLength": len("somewhere"),
+                "LastModified": datetime.now(tz=timezone.utc),
+            },
+        )
+        local_file.upload()
+        stubber.assert_no_pending_responses()
+    assert not local_file.local_has_changed()
+
+
+def test_download_skipped_when_etag_already_downloaded(local_file):
+    snapshot = FileSnapshot(
+        exists_local=True,
+        local_mtime=None,
+        local_size=len("somewhere"),
+        exists_remote=True,
+        remote_mtime=None,
+        remote_size=len("somewhere"),
+        etag=f'"{md5(b"somewhere").hexdigest()}"',
+    )
+    local_file._synced_etag = snapshot.etag
+    local_file.set_synced_mtime()
+    with Stubber(local_file.client):
+        local_file.download(snapshot=snapshot)
+
+
+def test_check_files_s3_changes_uploads_local_only_files(local_file):
+    with Stubber(local_file.client) as stubber:
+        stubber.add_client_error(
+            "head_object", service_error_code="404", http_status_code=404
+        )
+        stubber.add_response("put_object", {})
+        check_files_s3_changes([local_file])
+        stubber.assert_no_pending_responses()
+    assert not local_file.local_has_changed()
+
+
+def test_content_identical_compares_sizes_of_kms_objects(local_file):
+    with Stubber(local_file.client) as stubber:
+        stubber.add_response(
+            "head_object",
+            {
+                "ContentLength": len("somewhere"),
+                "ETag": '"d41d8cd98f00b204e9800998ecf8427e"',
+                "LastModified": datetime(2022, 1, 1, tzinfo=timezone.utc),
+                "ServerSideEncryption": "aws:kms",
+            },
+        )
+        snapshot = local_file.snapshot()
+    assert not snapshot.etag_is_md5
+    assert local_file.content_identical(snapshot)
+
+
+def test_same_size_change_after_sync_is_uploaded(local_file):
+    local_file.set_synced_mtime()
+    with open(local_file.path, "w") as file_fd:
+        file_fd.write("elsewhere")
+    utime(local_file.path, ns=(0, stat(local_file.path).st_mtime_ns + 1))
+    with Stubber(local_file.client) as stubber:
+        stubber.add_response(
+            "head_object",
+            {
+                "ContentLength": len("somewhere"),
+                "LastModified": datetime.now(tz=timezone.utc),
+            },
+        )
+        stubber.add_response("copy_object", {})
+        stubber.add_response("put_object", {})
+        local_file.upload()
+        stubber.assert_no_pending_responses()
@@ -0,0 +1,30 @@
+"""
+Tests for the SSM parameter values cache
+"""
+
+from boto3.session import Session
+from botocore.stub import Stubber
+
+from aws_s3_files_autosync.ssm_management import SsmParameter
+
+
+def test_current_value_is_cached_until_set():
+    parameter = SsmParameter(
+        {"name": "/over/the_rainbow"}, session=Session(region_name="eu-west-1")
+    )
+    with Stubber(parameter.client) as stubber:
+        stubber.add_response(
+            "get_parameter",
+            {"Parameter": {"Value": "somewhere"}},
+            {"Name": "/over/the_rainbow"},
+        )
+        assert parameter.current_value == "somewhere"
+        assert parameter.current_value == "somewhere"
+        stubber.add_response("put_parameter", {})
+        parameter.current_value = {"bucket": "sacrificial-lamb"}
+        stubber.add_response(
+            "get_parameter",
+            {"Parameter": {"Value": '{"bucket":"sacrificial-lamb"}'}},
+        )
+        assert parameter.current_value == '{"bucket":"sacrificial-lamb"}'
+        stubber.assert_no_pending_responses()